@@ -1,9 +1,11 @@
 # Import libraries
+import numpy as np
 import pandas as pd
 import folium
 from folium.plugins import HeatMap, Draw
 import json
 from branca.element import Template, MacroElement
+import shapely
 from shapely.geometry import Point, Polygon
 import streamlit as st
 import random
@@ -11,6 +13,9 @@ import string
 from streamlit_folium import st_folium
 import streamlit.components.v1 as components
 import time
+from ingest_cache import file_hash
+from map_jobs import get_job_manager, job_id
+from dataset_registry import open_dataset
 
 # Global variable to store polygon coordinates
 coordenadas_poligono = None
@@ -34,6 +39,40 @@ eventos_traducidos = {
     5020: "Impacto"
 }
 
+# Grid used to aggregate events: finest cell size in degrees and cells merged per precision
+tamano_celda_base = 0.001
+celdas_por_precision = {
+    'Baja': 10,
+    'Media': 5,
+    'Alta': 1
+}
+
+# RGB values of the colours used in the heatmap gradient
+colores_gradiente = {
+    'lightgreen': (144, 238, 144),
+    'yellow': (255, 255, 0),
+    'orange': (255, 165, 0),
+    'red': (255, 0, 0),
+    'darkred': (139, 0, 0)
+}
+
+# Maximum width or height in pixels of the raster overlays
+max_pixeles_raster = 2048
+
+# Rows filtered between two progress reports of a map job
+filas_por_bloque = 500_000
+
+# Stages of the map generation and the share of the progress bar each one takes
+etapas_mapa = [
+    ('Filtrando por fecha y hora', 0.3),
+    ('Filtrando por polígono', 0.2),
+    ('Generando capas', 0.4),
+    ('Finalizando', 0.1)
+]
+
+# Seconds between two checks of a running map job
+intervalo_sondeo = 0.5
+
 # Function to reset the app state automatically after download
 def reset_app_state():
     st.session_state.clear()
@@ -47,6 +86,16 @@ def generar_nombre_aleatorio(longitud=8):
 def cargar_datos(archivo_json):
     return pd.DataFrame(archivo_json['rows'])
 
+# Function to load event data from the columnar (Parquet) format
+def cargar_datos_columnar(archivo_parquet):
+    return pd.read_parquet(archivo_parquet)
+
+# Function to build the event frame of an upload, JSON or Parquet, shared by identical uploads
+def cargar_eventos(archivo_eventos):
+    if archivo_eventos.name.endswith('.parquet'):
+        return {'eventos': cargar_datos_columnar(archivo_eventos)}
+    return {'eventos': cargar_datos(json.load(archivo_eventos))}
+
 # Function to load polygon data
 def cargar_poligono(archivo_poligono, radio_circulo_grados=0.01):
     try:
@@ -62,14 +111,6 @@ def cargar_poligono(archivo_poligono, radio_circulo_grados=0.01):
     except KeyError as e:
         raise ValueError(f"Error al cargar el polígono: {e}")
 
-# Function to validate event JSON
-def validar_json_eventos(datos_eventos):
-    try:
-        pd.DataFrame(datos_eventos['rows'])
-        return "Eventos cargados con éxito"
-    except Exception as e:
-        return f"✘ Error: {e}"
-
 # Function to validate polygon JSON
 def validar_json_poligono(datos_poligono, radio_circulo_grados=0.01):
     try:
@@ -124,93 +165,295 @@ def agregar_leyenda(mapa, conteo_eventos, fecha_inicio, fecha_fin, hora_inicio,
     legend._template = Template(template)
     mapa.get_root().add_child(legend)
 
+# Function to report the progress of a map job in rows processed, and stop it if cancelled
+def informar_progreso(job, etapa, filas_hechas, filas_totales):
+    if job is None:
+        return
+    nombre, peso = etapas_mapa[etapa]
+    inicio = sum(peso_anterior for _, peso_anterior in etapas_mapa[:etapa])
+    avance = filas_hechas / filas_totales if filas_totales else 1
+    job.report(inicio + peso * avance, f"{nombre}: {filas_hechas:,} / {filas_totales:,} filas")
+    job.check_cancelled()
+
+# Function to apply a row mask in blocks, reporting progress after each block
+def filtrar_por_bloques(data, mascara, etapa, job=None):
+    total = len(data)
+    mascaras = []
+    for inicio in range(0, total, filas_por_bloque):
+        mascaras.append(mascara(data.iloc[inicio:inicio + filas_por_bloque]))
+        informar_progreso(job, etapa, min(inicio + filas_por_bloque, total), total)
+    return data[np.concatenate(mascaras)] if mascaras else data
+
+# Function to flag the events inside the polygon
+def mascara_poligono(data, poligono):
+    latitudes = data['Latitud'].to_numpy()
+    longitudes = data['Longitud'].to_numpy()
+
+    # Bounding-box prefilter on the coordinate arrays
+    min_lon, min_lat, max_lon, max_lat = poligono.bounds
+    dentro = (longitudes >= min_lon) & (longitudes <= max_lon) & (latitudes >= min_lat) & (latitudes <= max_lat)
+
+    # Exact containment only for the candidates, against the prepared geometry
+    candidatos = np.flatnonzero(dentro)
+    shapely.prepare(poligono)
+    dentro[candidatos] = shapely.contains_xy(poligono, longitudes[candidatos], latitudes[candidatos])
+    return dentro
+
+# Function to split the event coordinates (or other columns) by type in a single pass
+def agrupar_por_tipo(data, columnas=('Latitud', 'Longitud')):
+    tipos = data['TipoEvento'].to_numpy()
+    orden = np.argsort(tipos, kind='stable')
+    codigos, inicios = np.unique(tipos[orden], return_index=True)
+    coordenadas = np.column_stack([data[columna].to_numpy()[orden] for columna in columnas])
+    return dict(zip(codigos.tolist(), np.split(coordenadas, inicios[1:])))
+
+# Function to bin the events once at load time by day, hour, type and base grid cell
+def construir_cubo_eventos(data):
+    data = data.dropna(subset=['Fecha', 'Latitud', 'Longitud', 'TipoEvento'])
+    fechas = pd.to_datetime(data['Fecha'], unit='ms')
+    claves = pd.DataFrame({
+        'Dia': fechas.dt.normalize().to_numpy(),
+        'Hora': fechas.dt.hour.to_numpy(np.int8),
+        'TipoEvento': data['TipoEvento'].to_numpy(),
+        'CeldaLat': np.floor(data['Latitud'].to_numpy() / tamano_celda_base).astype(np.int32),
+        'CeldaLon': np.floor(data['Longitud'].to_numpy() / tamano_celda_base).astype(np.int32)
+    })
+
+    # One row per occupied bin, sorted by day and hour so a date range is a contiguous slice
+    conteos = claves.groupby(list(claves.columns), sort=True).size()
+    return conteos.astype(np.int32).rename('Conteo').reset_index()
+
+# Function to select the bins of a date and hour range; as in the row filter, the end date is taken at midnight
+def filtrar_cubo(cubo, fecha_inicio, fecha_fin, hora_inicio, hora_fin):
+    desde, hasta = cubo['Dia'].searchsorted([fecha_inicio, fecha_fin])
+    celdas = cubo.iloc[desde:hasta]
+    celdas = celdas[(celdas['Hora'] >= hora_inicio) & (celdas['Hora'] <= hora_fin)]
+
+    # Cell centres stand for the events of each bin
+    return celdas.assign(
+        Latitud=(celdas['CeldaLat'] + 0.5) * tamano_celda_base,
+        Longitud=(celdas['CeldaLon'] + 0.5) * tamano_celda_base
+    )
+
+# Function to aggregate event coordinates into one weighted point per grid cell
+def agregar_en_rejilla(coordenadas, precision):
+    celdas = np.floor(coordenadas / tamano_celda_base)
+    return agregar_celdas_en_rejilla(celdas, np.ones(len(coordenadas)), precision)
+
+# Function to merge base grid cells with their counts into one weighted point per cell of the precision
+def agregar_celdas_en_rejilla(celdas, conteos, precision):
+    factor = celdas_por_precision.get(precision, celdas_por_precision['Media'])
+    celdas_ocupadas, inversa = np.unique(celdas.astype(np.int64) // factor, axis=0, return_inverse=True)
+    conteos = np.bincount(inversa.ravel(), weights=conteos)
+    centros = (celdas_ocupadas + 0.5) * (tamano_celda_base * factor)
+    return np.column_stack([centros, conteos]).tolist()
+
+# Function to compute the geographic extent and pixel size shared by the raster layers
+def calcular_rejilla_raster(data, radius):
+    tamano = tamano_celda_base
+    lat_min, lat_max = data['Latitud'].min(), data['Latitud'].max()
+    lon_min, lon_max = data['Longitud'].min(), data['Longitud'].max()
+    tamano = max(tamano, (lat_max - lat_min) / max_pixeles_raster, (lon_max - lon_min) / max_pixeles_raster)
+
+    # Pad the extent so the blur is not cut at the borders
+    margen = (radius + 1) * tamano
+    return (lat_min - margen, lat_max + margen, lon_min - margen, lon_max + margen), tamano
+
+# Function to blur a 2D array with a separable Gaussian kernel
+def desenfocar(matriz, radius, blur):
+    desplazamientos = np.arange(-radius, radius + 1)
+    nucleo = np.exp(-0.5 * (desplazamientos / max(blur / 2, 0.5)) ** 2)
+    nucleo /= nucleo.sum()
+
+    for eje in (0, 1):
+        relleno = [(0, 0), (0, 0)]
+        relleno[eje] = (radius, radius)
+        ampliada = np.pad(matriz, relleno)
+        longitud = matriz.shape[eje]
+        matriz = sum(peso * np.take(ampliada, np.arange(k, k + longitud), axis=eje) for k, peso in enumerate(nucleo))
+    return matriz
+
+# Function to colour a density surface with the heatmap gradient as an RGBA image
+def colorear_densidad(densidad, gradient, min_opacity=0.3):
+    maximo = densidad.max()
+    normalizada = densidad / maximo if maximo > 0 else densidad
+    paradas = sorted(gradient)
+    rgb = np.array([colores_gradiente[gradient[parada]] for parada in paradas], dtype=float)
+
+    imagen = np.zeros(densidad.shape + (4,), dtype=np.uint8)
+    for canal in range(3):
+        imagen[..., canal] = np.interp(normalizada, paradas, rgb[:, canal])
+    alfa = np.where(normalizada > 1e-3, min_opacity + (1 - min_opacity) * normalizada, 0)
+    imagen[..., 3] = (alfa * 255).astype(np.uint8)
+
+    # Image rows go from north to south
+    return imagen[::-1]
+
+# Function to render the density of some events as a raster overlay
+def rasterizar_densidad(coordenadas, limites, tamano, radius, blur, gradient, pesos=None):
+    lat_min, lat_max, lon_min, lon_max = limites
+    filas = max(int(np.ceil((lat_max - lat_min) / tamano)), 1)
+    columnas = max(int(np.ceil((lon_max - lon_min) / tamano)), 1)
+    histograma, _, _ = np.histogram2d(
+        coordenadas[:, 0], coordenadas[:, 1],
+        bins=[filas, columnas],
+        range=[[lat_min, lat_max], [lon_min, lon_max]],
+        weights=pesos
+    )
+    imagen = colorear_densidad(desenfocar(histograma, radius, blur), gradient)
+    return folium.raster_layers.ImageOverlay(
+        image=imagen,
+        bounds=[[lat_min, lon_min], [lat_max, lon_max]],
+        mercator_project=True
+    )
+
 # Function to export the map
 def exportar_mapa(mapa, nombre_archivo):
     mapa.save(nombre_archivo)
 
-# Function to generate the heatmap with layers and progress bar
-def generar_mapa_con_progreso(data, fecha_inicio, fecha_fin, hora_inicio, hora_fin, precision, poligono=None):
-    progress_bar = st.progress(0)  # Initialize progress bar
-    try:
-        progress_bar.progress(10)  # Step 1: Loading initial data
+# Function to generate the heatmap with layers, reporting progress to its background job
+def generar_mapa_con_progreso(data, fecha_inicio, fecha_fin, hora_inicio, hora_fin, precision, poligono=None, modo='Puntos', cubo=None, job=None):
+    zoom_start = 0
+    fecha_inicio = pd.to_datetime(fecha_inicio)
+    fecha_fin = pd.to_datetime(fecha_fin)
+    conteo_eventos = {}
 
-        zoom_start = 0
-        data['Fecha'] = pd.to_datetime(data['Fecha'], unit='ms')
-        fecha_inicio = pd.to_datetime(fecha_inicio)
-        fecha_fin = pd.to_datetime(fecha_fin)
+    # Aggregated and raster maps without a polygon only need the event cube, not the rows
+    desde_cubo = cubo is not None and poligono is None and modo in ('Agregado', 'Raster')
 
-        data = data[(data['Fecha'] >= fecha_inicio) & (data['Fecha'] <= fecha_fin)]
-        data = data[(data['Fecha'].dt.hour >= hora_inicio) & (data['Fecha'].dt.hour <= hora_fin)]
-        progress_bar.progress(25)  # Step 2: Data filtered by date and time
+    if desde_cubo:
+        # Steps 1 and 2: slice the bins of the date range and keep the hours
+        data = filtrar_cubo(cubo, fecha_inicio, fecha_fin, hora_inicio, hora_fin)
+        informar_progreso(job, 1, len(data), len(data))
+    else:
+        # Step 1: filter by date and time, in blocks of rows; the shared frame is never modified
+        def mascara_fecha(bloque):
+            fechas = pd.to_datetime(bloque['Fecha'], unit='ms')
+            horas = fechas.dt.hour
+            return ((fechas >= fecha_inicio) & (fechas <= fecha_fin) & (horas >= hora_inicio) & (horas <= hora_fin)).to_numpy()
 
-        conteo_eventos = {}
-        if poligono is not None:
-            puntos = [Point(lon, lat) for lat, lon in zip(data['Latitud'], data['Longitud'])]
-            data = data[[poligono.contains(punto) for punto in puntos]]
-        progress_bar.progress(50)  # Step 3: Filtered by polygon
-
-        if not data.empty:
-            centro_lat = data['Latitud'].mean()
-            centro_lon = data['Longitud'].mean()
-            zoom_start = 12
-        else:
-            centro_lat = 40.3453  # Default lat
-            centro_lon = -3.6604  # Default lon
-            zoom_start = 6
-        progress_bar.progress(60)  # Step 4: Map center calculated
-
-        mapa = folium.Map(location=[centro_lat, centro_lon], zoom_start=zoom_start)
-        capa_evento = folium.FeatureGroup(name="Eventos")
-
-        precision_values = {
-            'Baja': (15, 15),
-            'Media': (10, 10),
-            'Alta': (3, 3)
-        }
-        radius, blur = precision_values.get(precision, (10, 10))
-
-        if 'TipoEvento' in data.columns and not data.empty:
-            data = data[data['TipoEvento'].isin(eventos_traducidos.keys())]
-            gradient = {0: 'lightgreen', 0.25: 'yellow', 0.5: 'orange', 0.75: 'red', 1: 'darkred'}
-            max_densidad = data.shape[0]
-
-            for tipo_evento, descripcion in eventos_traducidos.items():
-                datos_filtrados = data[data['TipoEvento'] == tipo_evento]
-                conteo_eventos[descripcion] = len(datos_filtrados)
-                heat_data = [[row['Latitud'], row['Longitud'], 1] for _, row in datos_filtrados.iterrows()]
-                if heat_data:
-                    capa_evento = folium.FeatureGroup(name=descripcion)
-                    HeatMap(
-                        heat_data, 
-                        min_opacity=0.3, 
-                        radius=radius, 
-                        blur=blur, 
-                        gradient=gradient, 
-                        max_zoom=18,
-                        max_value=max_densidad
-                    ).add_to(capa_evento)
-                    capa_evento.add_to(mapa)
-        progress_bar.progress(85)  # Step 5: Added heatmap layers
-
-        # Add draw tool and legend
-        folium.LayerControl().add_to(mapa)
-        draw = Draw(export=True)
-        draw.add_to(mapa)
-        agregar_leyenda(mapa, conteo_eventos, fecha_inicio, fecha_fin, hora_inicio, hora_fin)
-        progress_bar.progress(100)  # Step 6: Final touches
-
-        archivo_salida = f"Mapa_Calor_Polygon_{generar_nombre_aleatorio()}.html"
-        return mapa, archivo_salida, conteo_eventos
+        data = filtrar_por_bloques(data, mascara_fecha, 0, job)
 
+        # Step 2: filter by polygon
+        if poligono is not None:
+            shapely.prepare(poligono)
+            data = filtrar_por_bloques(data, lambda bloque: mascara_poligono(bloque, poligono), 1, job)
+        informar_progreso(job, 1, len(data), len(data))
+
+    if not data.empty:
+        pesos_centro = data['Conteo'] if desde_cubo else None
+        centro_lat = np.average(data['Latitud'], weights=pesos_centro)
+        centro_lon = np.average(data['Longitud'], weights=pesos_centro)
+        zoom_start = 12
+    else:
+        centro_lat = 40.3453  # Default lat
+        centro_lon = -3.6604  # Default lon
+        zoom_start = 6
+
+    mapa = folium.Map(location=[centro_lat, centro_lon], zoom_start=zoom_start)
+    capa_evento = folium.FeatureGroup(name="Eventos")
+
+    precision_values = {
+        'Baja': (15, 15),
+        'Media': (10, 10),
+        'Alta': (3, 3)
+    }
+    radius, blur = precision_values.get(precision, (10, 10))
+
+    # Step 3: one heatmap layer per event type, reporting the events drawn so far
+    if 'TipoEvento' in data.columns and not data.empty:
+        gradient = {0: 'lightgreen', 0.25: 'yellow', 0.5: 'orange', 0.75: 'red', 1: 'darkred'}
+        # Cube bins carry their cell and event count after the cell centre
+        columnas = ('Latitud', 'Longitud', 'CeldaLat', 'CeldaLon', 'Conteo') if desde_cubo else ('Latitud', 'Longitud')
+        grupos = agrupar_por_tipo(data, columnas)
+        sin_eventos = np.empty((0, len(columnas)))
+        contar = (lambda valores: int(valores[:, 4].sum())) if desde_cubo else len
+        max_densidad = sum(contar(grupos.get(tipo_evento, sin_eventos)) for tipo_evento in eventos_traducidos)
+        if modo == 'Raster':
+            limites, tamano = calcular_rejilla_raster(data, radius)
+
+        eventos_procesados = 0
+        for tipo_evento, descripcion in eventos_traducidos.items():
+            valores = grupos.get(tipo_evento, sin_eventos)
+            coordenadas = valores[:, :2]
+            pesos = valores[:, 4] if desde_cubo else None
+            conteo_eventos[descripcion] = contar(valores)
+            if conteo_eventos[descripcion] and modo == 'Raster':
+                capa_evento = folium.FeatureGroup(name=descripcion)
+                rasterizar_densidad(coordenadas, limites, tamano, radius, blur, gradient, pesos).add_to(capa_evento)
+                capa_evento.add_to(mapa)
+            elif conteo_eventos[descripcion]:
+                if modo == 'Agregado' and desde_cubo:
+                    heat_data = agregar_celdas_en_rejilla(valores[:, 2:4], pesos, precision)
+                elif modo == 'Agregado':
+                    heat_data = agregar_en_rejilla(coordenadas, precision)
+                else:
+                    heat_data = np.column_stack([coordenadas, np.ones(len(coordenadas))]).tolist()
+                capa_evento = folium.FeatureGroup(name=descripcion)
+                HeatMap(
+                    heat_data, 
+                    min_opacity=0.3, 
+                    radius=radius, 
+                    blur=blur, 
+                    gradient=gradient, 
+                    max_zoom=18,
+                    max_value=max_densidad
+                ).add_to(capa_evento)
+                capa_evento.add_to(mapa)
+            eventos_procesados += conteo_eventos[descripcion]
+            informar_progreso(job, 2, eventos_procesados, max_densidad)
+
+    # Step 4: add draw tool and legend
+    folium.LayerControl().add_to(mapa)
+    draw = Draw(export=True)
+    draw.add_to(mapa)
+    agregar_leyenda(mapa, conteo_eventos, fecha_inicio, fecha_fin, hora_inicio, hora_fin)
+    informar_progreso(job, 3, len(data), len(data))
+
+    return mapa, conteo_eventos
+
+# Function to show the progress of the session's map job, polling it without blocking the script
+@st.fragment(run_every=intervalo_sondeo)
+def seguir_trabajo_mapa():
+    trabajo = st.session_state.get('trabajo_mapa')
+    if trabajo is None:
+        return
+
+    if not trabajo.done():
+        st.progress(trabajo.fraction, text=trabajo.text or "En cola...")
+        if st.button("Cancelar", key="cancelar_mapa"):
+            # The job itself stops only when no other session is waiting for it
+            get_job_manager().release(trabajo)
+            del st.session_state['trabajo_mapa']
+            st.warning("Generación del mapa cancelada.")
+        return
+
+    get_job_manager().release(trabajo)
+    del st.session_state['trabajo_mapa']
+    try:
+        mapa, conteo_eventos = trabajo.result()
     except Exception as e:
         st.error(f"Error al generar el mapa: {e}")
-        return None, None, None
+        return
+
+    # Sessions attached to the same job share the map, so each one exports to its own file
+    archivo_salida = f"Mapa_Calor_Polygon_{generar_nombre_aleatorio()}.html"
+
+    # Store map and relevant data in session state, and show it on the next full run
+    st.session_state['map_generated'] = True
+    st.session_state['mapa'] = mapa
+    st.session_state['archivo_salida'] = archivo_salida
+    st.session_state['conteo_eventos'] = conteo_eventos
+    st.session_state['mostrar_mapa'] = True
+    st.rerun()
 
 
 # Streamlit configuration
 st.set_page_config(layout="wide")
 st.title("Aplicación de Mapa de Calor de Eventos")
-datos_eventos = None
+eventos = None
+eventos_df = None
+cubo_eventos = None
 poligono = None
 
 # Flag to check if the map was generated by clicking the button
@@ -220,12 +463,17 @@ mapa_generado_con_boton = False
 col1, col2 = st.columns(2)
 
 with col1:
-    uploaded_file_eventos = st.file_uploader("Sube tu archivo JSON de eventos", type=["json"], key="file_eventos")
+    uploaded_file_eventos = st.file_uploader("Sube tu archivo JSON o Parquet de eventos", type=["json", "parquet"], key="file_eventos")
     if uploaded_file_eventos is not None:
         try:
-            datos_eventos = json.load(uploaded_file_eventos)
-            validacion_eventos = validar_json_eventos(datos_eventos)
-            st.success(validacion_eventos)
+            # The frame is built once per content hash, not on every rerun
+            eventos = open_dataset(uploaded_file_eventos, 'eventos', cargar_eventos)
+            eventos_df = eventos['eventos']
+            st.success("Eventos cargados con éxito")
+
+            # Bin the events once per upload; the cube is shared by the sessions that upload the same file
+            if {'Fecha', 'Latitud', 'Longitud', 'TipoEvento'} <= set(eventos_df.columns):
+                cubo_eventos = open_dataset(uploaded_file_eventos, 'eventos_cubo', lambda archivo: {'cubo': construir_cubo_eventos(eventos_df)})['cubo']
         except Exception as e:
             st.error(f"Error al cargar el archivo de eventos: {e}")
 
@@ -251,30 +499,44 @@ with col1:
 with col2:
     fecha_fin = st.date_input("Fecha de fin")
     hora_fin = st.number_input("Hora de fin (0-23)", min_value=0, max_value=23, value=23)
+    modo = st.selectbox("Modo de mapa", options=['Puntos', 'Agregado', 'Raster'],
+                        help="Agregado agrupa los eventos en una rejilla según la precisión y reduce el tamaño del mapa. "
+                             "Raster calcula la densidad en el servidor y la añade como imagen, independiente del número de eventos")
 
-# Generate map button
+# Generate map button: the map is built by a background job shared by identical requests
 if st.button("Generar Mapa", key="generar_mapa"):
     try:
-        if datos_eventos is not None:
-            eventos_df = cargar_datos(datos_eventos)
-            mapa, archivo_salida, conteo_eventos = generar_mapa_con_progreso(eventos_df, fecha_inicio, fecha_fin, hora_inicio, hora_fin, precision, poligono)
-
-            # Show the map only the first time when generating, not after export
-            map_container = st.empty()
-            if not st.session_state.get('export_successful', False):  # Only show the map if it's not exported yet
-                with map_container:
-                    components.html(mapa._repr_html_(), height=800)
-
-            # Store map and relevant data in session state
-            st.session_state['map_generated'] = True
-            st.session_state['mapa'] = mapa
-            st.session_state['archivo_salida'] = archivo_salida
-            st.session_state['conteo_eventos'] = conteo_eventos
+        if eventos_df is not None:
+            clave = job_id(
+                eventos.key,
+                file_hash(uploaded_file_poligono) if poligono is not None else None,
+                fecha_inicio, fecha_fin, hora_inicio, hora_fin, precision, modo
+            )
+            gestor = get_job_manager()
+            anterior = st.session_state.get('trabajo_mapa')
+
+            # Clicking again with the same parameters keeps following the job already attached
+            if anterior is None or anterior.key != clave or anterior.cancel_event.is_set():
+                # Attach to the new job before leaving the previous one, so a shared job is never restarted
+                st.session_state['trabajo_mapa'] = gestor.submit(
+                    clave, generar_mapa_con_progreso,
+                    eventos_df, fecha_inicio, fecha_fin, hora_inicio, hora_fin, precision, poligono, modo, cubo_eventos
+                )
+                if anterior is not None:
+                    gestor.release(anterior)
         else:
-            st.error("Por favor, sube un archivo JSON de eventos válido.")
+            st.error("Por favor, sube un archivo JSON o Parquet de eventos válido.")
     except Exception as e:
         st.error(f"Error: {e}")
 
+seguir_trabajo_mapa()
+
+# Show the map only the first time after it is generated, not after export
+if st.session_state.pop('mostrar_mapa', False) and not st.session_state.get('export_successful', False):
+    map_container = st.empty()
+    with map_container:
+        components.html(st.session_state['mapa']._repr_html_(), height=800)
+
 # Check if the export button should be enabled based on the presence of events in the map
 exportar_button_enabled = False
 if 'conteo_eventos' in st.session_state and any(st.session_state['conteo_eventos'].values()):
@@ -0,0 +1,144 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+import streamlit as st
+
+from dataset_registry import get_registry
+from ingest_cache import file_hash, write_parquet_atomic
+from speed_cube import build_hourly_cube_chunked, combine_cubes
+from speed_sketch import StreamingSketch, combine_sketches
+
+# Directory of the persistent aggregate store
+STORE_DIR = os.environ.get('DASHBOARD_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aggregate_store'))
+
+# File listing the content hashes already ingested
+MANIFEST_NAME = '_ingested.json'
+
+# Serializes appends from concurrent sessions
+_append_lock = threading.Lock()
+
+
+def manifest_path(store_dir=STORE_DIR):
+    return os.path.join(store_dir, MANIFEST_NAME)
+
+
+def read_manifest(store_dir=STORE_DIR):
+    """
+    Return the ingested files of the store, keyed by content hash.
+    """
+    try:
+        with open(manifest_path(store_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest, store_dir=STORE_DIR):
+    path = manifest_path(store_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def store_version(store_dir=STORE_DIR):
+    """
+    Return a digest identifying the current contents of the store.
+    """
+    return hashlib.sha256(','.join(sorted(read_manifest(store_dir))).encode()).hexdigest()
+
+
+def append_file(file, datetime_format, store_dir=STORE_DIR, progress=None):
+    """
+    Aggregate a new speed export into the store, one Parquet part and one
+    speed sketch per date.
+
+    Returns the list of dates written, or None if a file with the same content
+    was already ingested.
+    """
+    content_hash = file_hash(file)
+    with _append_lock:
+        manifest = read_manifest(store_dir)
+        if content_hash in manifest:
+            return None
+
+        sketch = StreamingSketch()
+        cube = build_hourly_cube_chunked(file, datetime_format, progress=progress, on_chunk=sketch.add)
+        speeds = sketch.result()
+        sketches = dict(tuple(speeds.groupby('date')))
+        dates = []
+        for date, cells in cube.groupby('date'):
+            day = date.strftime('%Y-%m-%d')
+            # Every part gets a sketch, empty if the date has no speeds, so parts from older ingests stand out
+            write_parquet_atomic(sketches.get(date, speeds.iloc[:0]), os.path.join(store_dir, day, f"sketch-{content_hash[:16]}.parquet"))
+            write_parquet_atomic(cells, os.path.join(store_dir, day, f"part-{content_hash[:16]}.parquet"))
+            dates.append(day)
+
+        manifest[content_hash] = {'name': getattr(file, 'name', None), 'dates': dates, 'cells': len(cube)}
+        write_manifest(manifest, store_dir)
+        return dates
+
+
+def load_store(store_dir=STORE_DIR):
+    """
+    Read every partition of the store into one hourly cube and one speed sketch.
+
+    The sketch is None when some parts were ingested before sketches were
+    stored, since percentiles over part of the data would be misleading.
+    """
+    parts = sorted(glob.glob(os.path.join(store_dir, '*', 'part-*.parquet')))
+    if not parts:
+        raise ValueError("The aggregate store is empty")
+
+    cube = combine_cubes([pd.read_parquet(part) for part in parts])
+    sketch_parts = [os.path.join(os.path.dirname(part), 'sketch-' + os.path.basename(part)[len('part-'):]) for part in parts]
+    sketch = None
+    if all(os.path.exists(part) for part in sketch_parts):
+        sketch = combine_sketches([pd.read_parquet(part) for part in sketch_parts])
+
+    for frame in (cube, sketch):
+        if frame is None:
+            continue
+        for key in ('carretera', 'sentido'):
+            if key in frame.columns:
+                frame[key] = frame[key].astype('category')
+    return cube, sketch
+
+
+def open_store_dataset(kind, build, store_dir=STORE_DIR):
+    """
+    Return a registry handle on the dataset that `build(cube, sketch)` makes
+    from the store, rebuilt only when new files have been appended.
+    """
+    key = f"{kind}:store:{store_version(store_dir)}"
+    return get_registry().get_or_load(key, lambda: build(*load_store(store_dir)))
+
+
+def append_uploads(datetime_format, store_dir=STORE_DIR):
+    """
+    Show an uploader that appends daily CSV exports to the store.
+    """
+    daily_file = st.file_uploader("Append a daily CSV export to the store", type="csv", key="store_upload")
+    appended = st.session_state.setdefault('store_appended', set())
+    if daily_file is None or daily_file.file_id in appended:
+        return
+
+    progress_bar = st.progress(0.0, text="Aggregating new file...")
+    try:
+        dates = append_file(daily_file, datetime_format, store_dir,
+                            progress=lambda fraction: progress_bar.progress(fraction, text=f"Aggregating new file... {fraction:.0%}"))
+    except Exception as e:
+        st.error(f"Error appending file: {e}")
+        return
+    finally:
+        progress_bar.empty()
+
+    appended.add(daily_file.file_id)
+    if dates is None:
+        st.info("This file was already ingested; nothing to do.")
+    else:
+        st.success(f"Added {len(dates)} date(s) to the store: {', '.join(dates)}")
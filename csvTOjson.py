@@ -1,31 +1,99 @@
+import argparse
 import csv
 import json
 
-# Nombre del archivo CSV de entrada
-csv_file = 'C:\\Users\\dmurias\\Downloads\\eventosMurcia_v1.csv'
-# Nombre del archivo JSON de salida
-json_file = 'C:\\Users\\dmurias\\Downloads\\eventosMurcia.json'
+# Número de filas que se convierten antes de cada escritura
+TAMANO_BLOQUE = 10000
 
-# Inicializar la estructura del JSON
-data = {
-    "table": "Ruta",
-    "rows": []
+# Separadores sin espacios para una salida compacta
+SEPARADORES = (',', ':')
+
+
+# Convertir una fila del CSV a los tipos del JSON de eventos
+def convertir_fila(row):
+    return {
+        "TipoEvento": int(row['TipoEvento']),
+        "Latitud": float(row['Latitud']),
+        "Longitud": float(row['Longitud']),
+        "Fecha": int(row['Fecha'])
+    }
+
+
+# Leer el archivo CSV por bloques de filas, sin cargarlo entero en memoria
+def leer_bloques(csv_file, tamano_bloque=TAMANO_BLOQUE):
+    with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
+        reader = csv.DictReader(file, delimiter='\t')  # Utiliza tabulaciones como delimitador
+        bloque = []
+        for row in reader:
+            bloque.append(convertir_fila(row))
+            if len(bloque) == tamano_bloque:
+                yield bloque
+                bloque = []
+        if bloque:
+            yield bloque
+
+
+# Escribir los bloques como un único JSON compacto {"table": "Ruta", "rows": [...]}
+def escribir_json(bloques, json_file):
+    with open(json_file, mode='w', encoding='utf-8') as file:
+        file.write('{"table":"Ruta","rows":[')
+        separador = ''
+        for bloque in bloques:
+            file.write(separador)
+            file.write(','.join(json.dumps(fila, separators=SEPARADORES) for fila in bloque))
+            separador = ','
+        file.write(']}')
+
+
+# Escribir los bloques como NDJSON, un evento por línea
+def escribir_ndjson(bloques, json_file):
+    with open(json_file, mode='w', encoding='utf-8') as file:
+        for bloque in bloques:
+            file.write(''.join(json.dumps(fila, separators=SEPARADORES) + '\n' for fila in bloque))
+
+
+# Escribir los bloques como Parquet tipado, un grupo de filas por bloque
+def escribir_parquet(bloques, parquet_file):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    esquema = pa.schema([
+        ('TipoEvento', pa.int16()),
+        ('Latitud', pa.float64()),
+        ('Longitud', pa.float64()),
+        ('Fecha', pa.int64())
+    ])
+    with pq.ParquetWriter(parquet_file, esquema) as writer:
+        for bloque in bloques:
+            writer.write_table(pa.Table.from_pylist(bloque, schema=esquema))
+
+
+escritores = {
+    'json': escribir_json,
+    'ndjson': escribir_ndjson,
+    'parquet': escribir_parquet
 }
 
-# Leer el archivo CSV y convertirlo a JSON
-with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
-    reader = csv.DictReader(file, delimiter='\t')  # Utiliza tabulaciones como delimitador
-    for row in reader:
-        # Agregar cada fila al JSON
-        data['rows'].append({
-            "TipoEvento": int(row['TipoEvento']),
-            "Latitud": float(row['Latitud']),
-            "Longitud": float(row['Longitud']),
-            "Fecha": int(row['Fecha'])
-        })
-
-# Guardar el resultado en un archivo JSON
-with open(json_file, mode='w', encoding='utf-8') as file:
-    json.dump(data, file, indent=4)
-
-print(f'El archivo JSON ha sido creado: {json_file}')
+
+# Validar en argparse que un tamaño de bloque sea un entero positivo
+def entero_positivo(valor):
+    numero = int(valor)
+    if numero <= 0:
+        raise argparse.ArgumentTypeError(f"debe ser un entero positivo: {valor}")
+    return numero
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convierte un CSV de eventos separado por tabulaciones a JSON, NDJSON o Parquet.")
+    parser.add_argument('csv_file', help="Archivo CSV de entrada")
+    parser.add_argument('output_file', help="Archivo de salida")
+    parser.add_argument('--formato', choices=sorted(escritores), default='json', help="Formato de salida (por defecto: json)")
+    parser.add_argument('--tamano-bloque', type=entero_positivo, default=TAMANO_BLOQUE, help="Filas convertidas antes de cada escritura")
+    args = parser.parse_args()
+
+    escritores[args.formato](leer_bloques(args.csv_file, args.tamano_bloque), args.output_file)
+    print(f'El archivo {args.formato.upper()} ha sido creado: {args.output_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,98 @@
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import streamlit as st
 import io
 import plotly.io as pio
-
-# Initialize global variable for the DataFrame
-df = pd.DataFrame()
+from ingest_cache import read_csv_cached
+from travel_time_prefix import TravelTimePrefixSums
+from dataset_registry import open_dataset
+from typed_load import optimize_dtypes
+from figure_cache import get_or_build, load_figure, show_cache_stats
+import sql_backend
+
+# Function to build the shared dataset from a CSV file
+def build_dataset(uploaded_file):
+    df = read_csv_cached(uploaded_file, {'date': '%Y-%m-%d'})
+
+    required_columns = ['date', 'hour', 'sentido', 'pkm', 'avg_time_diff']
+    for col in required_columns:
+        if col not in df.columns:
+            raise ValueError(f"Required column missing: {col}")
+
+    # Compact dtypes before building the derived structures
+    df, memory_report = optimize_dtypes(df, 'avg_time')
+
+    # Precompute cumulative hourly sums over PKM for every (sentido, date); the raw rows are not kept
+    return {
+        'prefix_sums': TravelTimePrefixSums(df),
+        'memory_report': memory_report,
+        'filters': {
+            'min_date': df['date'].min().date(),
+            'max_date': df['date'].max().date(),
+            'sentidos': df['sentido'].unique(),
+            'min_pkm': df['pkm'].min(),
+            'max_pkm': df['pkm'].max()
+        }
+    }
+
+# Function to build the shared dataset queried through the embedded SQL engine
+def build_sql_dataset(uploaded_file):
+    path = sql_backend.csv_to_parquet(uploaded_file, {'date': '%Y-%m-%d'})
+
+    # Only the Parquet path and the filter options are kept; every plot runs a query
+    return {'parquet_path': path, 'filters': sql_backend.travel_time_summary(path)}
 
 # Function to load CSV file
-def load_file(uploaded_file):
-    global df
+def load_file(uploaded_file, backend='pandas'):
     if uploaded_file is None:
         st.error("Please upload a valid CSV file.")
-        return False
+        return None
 
     try:
-        df = pd.read_csv(uploaded_file)
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-
-        required_columns = ['date', 'hour', 'sentido', 'pkm', 'avg_time_diff']
-        for col in required_columns:
-            if col not in df.columns:
-                raise ValueError(f"Required column missing: {col}")
+        if backend == 'DuckDB':
+            dataset = open_dataset(uploaded_file, 'avg_time_sql', build_sql_dataset)
+        else:
+            dataset = open_dataset(uploaded_file, 'avg_time', build_dataset)
 
         # Display available options for filters
         st.success(f"File loaded successfully.")
-        return True
+        if 'memory_report' in dataset:
+            st.caption(dataset['memory_report'])
+        return dataset
 
     except Exception as e:
         st.error(f"Error loading file: {e}")
-        return False
-
-def calculate_average_time_diff(selected_date, pkm1, pkm2, sentido):
-    selected_date = pd.to_datetime(selected_date).date()
+        return None
 
+def calculate_average_time_diff(dataset, selected_date, pkm1, pkm2, sentido):
     # Ensure pkm1 is smaller than pkm2 for proper range filtering
     pkm_min, pkm_max = min(pkm1, pkm2), max(pkm1, pkm2)
 
-    # Filter data based on the selected date, PKM range, and sentido
-    day_data = df[
-        (df['date'].dt.date == selected_date) &
-        (df['pkm'] >= pkm_min) & (df['pkm'] <= pkm_max) &
-        (df['sentido'] == sentido)
-    ]
+    if 'parquet_path' in dataset:
+        # Date, PKM and sentido predicates and the hourly sum run inside the SQL engine
+        time_diffs = sql_backend.travel_time_by_hour(dataset['parquet_path'], selected_date, pkm_min, pkm_max, sentido)
+        if time_diffs.empty:
+            return pd.DataFrame(columns=['hour', 'avg_time_diff']), 0
+        return arrange_hours(time_diffs)
+
+    # Sum of avg_time_diff per hour for PKMs in the range, for the selected date and sentido
+    hourly = dataset['prefix_sums'].hourly_sums(sentido, selected_date, pkm_min, pkm_max)
 
-    if day_data.empty:
+    if hourly is None:
         return pd.DataFrame(columns=['hour', 'avg_time_diff']), 0
 
-    # Calculate the sum of avg_time_diff per hour for PKMs in the range
-    time_diffs = day_data.groupby('hour').agg({'avg_time_diff': 'sum'}).reset_index()
+    # Keep only the hours that have rows in the range
+    sums, counts = hourly
+    hours_present = counts > 0
+    time_diffs = pd.DataFrame({
+        'hour': np.flatnonzero(hours_present),
+        'avg_time_diff': sums[hours_present]
+    })
 
+    return arrange_hours(time_diffs)
+
+def arrange_hours(time_diffs):
     # Invert the hour values: 0 becomes 23, 1 becomes 22, and so on
     time_diffs['hour'] = 23 - time_diffs['hour']
 
@@ -68,12 +111,12 @@ def calculate_average_time_diff(selected_date, pkm1, pkm2, sentido):
 
 
 
-def update_plot(selected_date, pkm1, pkm2, sentido):
-    if df.empty:
+def update_plot(dataset, selected_date, pkm1, pkm2, sentido):
+    if 'prefix_sums' in dataset and not dataset['prefix_sums'].blocks:
         st.error("No data available. Please upload a CSV file.")
         return None
 
-    time_diff_df, overall_avg_time_diff = calculate_average_time_diff(selected_date, pkm1, pkm2, sentido)
+    time_diff_df, overall_avg_time_diff = calculate_average_time_diff(dataset, selected_date, pkm1, pkm2, sentido)
 
     if time_diff_df.empty:
         st.warning("No data available for the selected criteria.")
@@ -113,7 +156,13 @@ def update_plot(selected_date, pkm1, pkm2, sentido):
         template='plotly_white'
     )
 
-    return fig
+    return time_diff_df, fig
+
+# Function to export a figure as HTML bytes for download
+def export_html(fig):
+    buf = io.StringIO()
+    pio.write_html(fig, buf)
+    return buf.getvalue().encode()
 
 # Streamlit app main function
 def main():
@@ -122,12 +171,16 @@ def main():
     # File upload section
     uploaded_file = st.file_uploader("Upload your CSV file", type="csv")
 
-    if uploaded_file is not None and load_file(uploaded_file):
-        min_date = df['date'].min().date()
-        max_date = df['date'].max().date()
-        unique_sentidos = df['sentido'].unique()
-        min_pkm = df['pkm'].min()
-        max_pkm = df['pkm'].max()
+    backend = sql_backend.backend_selector()
+
+    dataset = load_file(uploaded_file, backend) if uploaded_file is not None else None
+    if dataset is not None:
+        filters = dataset['filters']
+        min_date = filters['min_date']
+        max_date = filters['max_date']
+        unique_sentidos = filters['sentidos']
+        min_pkm = filters['min_pkm']
+        max_pkm = filters['max_pkm']
 
         # Date input for filtering
         selected_date = st.date_input("Select a Date", min_value=min_date, max_value=max_date, value=min_date)
@@ -139,24 +192,29 @@ def main():
         pkm1 = st.slider(f"Select Start PKM (available range: {min_pkm}-{max_pkm})", min_value=min_pkm, max_value=max_pkm, value=min_pkm)
         pkm2 = st.slider(f"Select End PKM (available range: {min_pkm}-{max_pkm})", min_value=min_pkm, max_value=max_pkm, value=max_pkm)
 
-        if st.button("Generate Plot"):
-            fig = update_plot(selected_date, pkm1, pkm2, sentido)
-
-            if fig:
-                st.plotly_chart(fig)
-
-                # Provide option to download the plot as HTML
-                buf = io.StringIO()
-                pio.write_html(fig, buf)
-                html_bytes = buf.getvalue().encode()
-
-                file_name = f"Traffic_Time_Avg_{selected_date}_{pkm1}_{pkm2}.html"
-                st.download_button(
-                    label="Download Plot as HTML",
-                    data=html_bytes,
-                    file_name=file_name,
-                    mime='text/html'
-                )
+        # Queries are O(24) on the prefix sums, or a pushed-down SQL aggregate, so the chart follows the widgets live
+        # Repeated filters on the same data are served from the shared figure cache
+        plot = get_or_build(
+            (dataset.key, selected_date, pkm1, pkm2, sentido),
+            lambda: update_plot(dataset, selected_date, pkm1, pkm2, sentido),
+            export_html
+        )
+
+        if plot:
+            st.plotly_chart(load_figure(plot))
+
+            # Provide option to download the plot as HTML
+            html_bytes = plot.html_bytes
+
+            file_name = f"Traffic_Time_Avg_{selected_date}_{pkm1}_{pkm2}.html"
+            st.download_button(
+                label="Download Plot as HTML",
+                data=html_bytes,
+                file_name=file_name,
+                mime='text/html'
+            )
+
+        show_cache_stats()
 
 # Run the Streamlit app
 if __name__ == "__main__":
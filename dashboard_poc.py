@@ -1,59 +1,135 @@
-import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime
 import streamlit as st
 import plotly.io as pio
 import io
+from ingest_cache import read_csv_cached
+from speed_cube import build_hourly_cube, build_hourly_cube_chunked, query_cube
+from speed_sketch import PERCENTILES, StreamingSketch, build_speed_sketch, percentile_column, query_percentiles
+from dataset_registry import open_dataset
+from typed_load import optimize_dtypes
+from aggregate_store import append_uploads, open_store_dataset
+from figure_cache import get_or_build, load_figure, show_cache_stats
+import sql_backend
 
-# Initialize global variable for the DataFrame
-df = pd.DataFrame()
+# Function to build the shared dataset from a CSV file
+def build_dataset(uploaded_file):
+    df = read_csv_cached(uploaded_file, {'tiempo': '%d-%m-%Y %H:%M:%S'})
+
+    # Check if necessary columns exist
+    if 'carretera' not in df.columns or 'velocidad_promedio' not in df.columns:
+        raise ValueError("Required columns are missing in the file")
+
+    # Compact dtypes before building the derived structures
+    df, memory_report = optimize_dtypes(df, 'speed_general')
+
+    # Pre-aggregate once so every plot only combines cube cells and sketches; the raw rows are not kept
+    return {'cube': build_hourly_cube(df), 'sketch': build_speed_sketch(df), 'memory_report': memory_report}
+
+# Function to build the shared dataset by streaming the CSV file in blocks
+def build_dataset_chunked(uploaded_file):
+    progress_bar = st.progress(0.0, text="Reading file in blocks...")
+    sketch = StreamingSketch()
+    cube = build_hourly_cube_chunked(
+        uploaded_file,
+        '%d-%m-%Y %H:%M:%S',
+        progress=lambda fraction: progress_bar.progress(fraction, text=f"Reading file in blocks... {fraction:.0%}"),
+        on_chunk=sketch.add
+    )
+    progress_bar.empty()
+    return {'cube': cube, 'sketch': sketch.result()}
+
+# Function to build the shared dataset queried through the embedded SQL engine
+def build_sql_dataset(uploaded_file):
+    path = sql_backend.csv_to_parquet(uploaded_file, {'tiempo': '%d-%m-%Y %H:%M:%S'})
+
+    # Only the Parquet path and the filter options are kept; every plot runs a query
+    return {'parquet_path': path, 'summary': sql_backend.speed_summary(path)}
+
+# Function to return the date range and roads of a dataset
+def dataset_summary(dataset):
+    if 'parquet_path' in dataset:
+        return dataset['summary']
+    cube = dataset['cube']
+    return {
+        'min_date': cube['date'].min().date(),
+        'max_date': cube['date'].max().date(),
+        'carreteras': cube['carretera'].unique()
+    }
 
 # Function to load CSV file
-def load_file(uploaded_file):
-    global df
+def load_file(uploaded_file, chunked=False, backend='pandas'):
     if uploaded_file is None:
         st.error("Please upload a valid CSV file.")
-        return False
+        return None
 
     try:
-        df = pd.read_csv(uploaded_file)
-        df['tiempo'] = pd.to_datetime(df['tiempo'], format='%d-%m-%Y %H:%M:%S')
-        df['date'] = df['tiempo'].dt.date
-        df['hour'] = df['tiempo'].dt.hour
-        
-        # Check if necessary columns exist
-        if 'carretera' not in df.columns or 'velocidad_promedio' not in df.columns:
-            raise ValueError("Required columns are missing in the file")
-        
+        if backend == 'DuckDB':
+            dataset = open_dataset(uploaded_file, 'speed_general_sql', build_sql_dataset)
+        elif chunked:
+            dataset = open_dataset(uploaded_file, 'speed_general_chunked', build_dataset_chunked)
+        else:
+            dataset = open_dataset(uploaded_file, 'speed_general', build_dataset)
         st.success("File loaded successfully.")
-        return True
+        if 'memory_report' in dataset:
+            st.caption(dataset['memory_report'])
+        return dataset
     
     except Exception as e:
         st.error(f"Error loading file: {e}")
-        return False
+        return None
 
-# Function to update the plot
-def update_plot(start_date, end_date):
-    if df.empty:
-        st.error("No data available. Please upload a CSV file.")
+# Function to build the shared dataset from the aggregate store
+def build_store_dataset(cube, sketch):
+    # The sketch is missing when the store holds files ingested before sketches were stored
+    if sketch is None:
+        return {'cube': cube}
+    return {'cube': cube, 'sketch': sketch}
+
+# Function to open the dataset from the persistent aggregate store
+def load_from_store():
+    try:
+        dataset = open_store_dataset('speed_general', build_store_dataset)
+        st.success("Aggregate store loaded successfully.")
+        return dataset
+
+    except Exception as e:
+        st.error(f"Error loading aggregate store: {e}")
         return None
 
-    # Filter data based on the selected date range
-    filtered_df = df[(df['date'] >= start_date) & (df['date'] <= end_date)]
+# Function to update the plot
+def update_plot(dataset, start_date, end_date, statistic='Mean'):
+    percentiles = statistic == 'Percentiles'
+
+    if 'parquet_path' in dataset:
+        # Date predicate and hourly aggregation run inside the SQL engine
+        grouped_df = sql_backend.speed_by_road_hour(dataset['parquet_path'], start_date, end_date,
+                                                    percentiles=PERCENTILES if percentiles else None)
+    else:
+        cube = dataset['cube']
+        if cube.empty:
+            st.error("No data available. Please upload a CSV file.")
+            return None
+
+        # Mean velocity and number of entries per 'carretera' and 'hour' for the selected date range
+        grouped_df = query_cube(cube, start_date, end_date)
+
+        if percentiles:
+            if 'sketch' not in dataset:
+                st.warning("Speed percentiles are not available: the aggregate store holds files ingested before percentiles were supported.")
+                return None
+
+            # Percentiles come from merging the quantile sketches of the selected cells
+            grouped_df = grouped_df.merge(query_percentiles(dataset['sketch'], start_date, end_date), on=['carretera', 'hour'], how='left')
     
-    if filtered_df.empty:
+    if grouped_df.empty:
         st.warning("No data available for the selected date range.")
         return None
-    
-    # Group by 'carretera' and 'hour', then calculate the mean velocity
-    grouped_df = filtered_df.groupby(['carretera', 'hour'])['velocidad_promedio'].mean().reset_index()
-    
-    # Calculate the number of entries per 'carretera' and 'hour'
-    entries_count_df = filtered_df.groupby(['carretera', 'hour']).size().reset_index(name='entries')
+    entries_count_df = grouped_df
     
     # Create a consistent color map for each carretera
-    unique_carreteras = df['carretera'].unique()
+    unique_carreteras = dataset_summary(dataset)['carreteras']
     colors = {carretera: f'rgba({int(255 * i / len(unique_carreteras))}, {int(255 * (len(unique_carreteras) - i) / len(unique_carreteras))}, 150, 1)'
               for i, carretera in enumerate(unique_carreteras)}
     
@@ -62,7 +138,7 @@ def update_plot(start_date, end_date):
         rows=2, cols=1, 
         shared_xaxes=False, 
         vertical_spacing=0.2,
-        subplot_titles=('Average Speed by Road and Hour', 'Number of Entries by Road and Hour'),
+        subplot_titles=('Speed Percentiles by Road and Hour' if percentiles else 'Average Speed by Road and Hour', 'Number of Entries by Road and Hour'),
         row_width=[0.3, 0.7]
     )
     
@@ -71,18 +147,33 @@ def update_plot(start_date, end_date):
         carretera_grouped_df = grouped_df[grouped_df['carretera'] == carretera]
         carretera_entries_df = entries_count_df[entries_count_df['carretera'] == carretera]
         
-        # Add line plot trace
-        fig.add_trace(go.Scatter(
-            x=carretera_grouped_df['hour'],
-            y=carretera_grouped_df['velocidad_promedio'],
-            mode='lines+markers',
-            name=carretera,
-            marker=dict(size=8, line=dict(width=1, color=colors[carretera])),
-            line=dict(width=2, color=colors[carretera]),
-            showlegend=True,
-            legendgroup=carretera,
-            hovertemplate='%{y:.2f}<extra></extra>'
-        ), row=1, col=1)
+        # Add line plot trace, or one trace per percentile with the median drawn solid
+        if percentiles:
+            for p in PERCENTILES:
+                column = percentile_column(p)
+                fig.add_trace(go.Scatter(
+                    x=carretera_grouped_df['hour'],
+                    y=carretera_grouped_df[column],
+                    mode='lines+markers',
+                    name=f'{carretera} {column}',
+                    marker=dict(size=8, line=dict(width=1, color=colors[carretera])),
+                    line=dict(width=2, color=colors[carretera], dash='solid' if p == 0.5 else 'dot'),
+                    showlegend=True,
+                    legendgroup=carretera,
+                    hovertemplate=f'{column}: %{{y:.2f}}<extra></extra>'
+                ), row=1, col=1)
+        else:
+            fig.add_trace(go.Scatter(
+                x=carretera_grouped_df['hour'],
+                y=carretera_grouped_df['velocidad_promedio'],
+                mode='lines+markers',
+                name=carretera,
+                marker=dict(size=8, line=dict(width=1, color=colors[carretera])),
+                line=dict(width=2, color=colors[carretera]),
+                showlegend=True,
+                legendgroup=carretera,
+                hovertemplate='%{y:.2f}<extra></extra>'
+            ), row=1, col=1)
         
         # Add bar plot trace
         fig.add_trace(go.Bar(
@@ -98,7 +189,7 @@ def update_plot(start_date, end_date):
     # Update layout for a professional look
     fig.update_layout(
         title={
-            'text': f'Report of Average Speed and Entries from {start_date} to {end_date}',
+            'text': f'Report of {"Speed Percentiles" if percentiles else "Average Speed"} and Entries from {start_date} to {end_date}',
             'font': {'size': 18, 'family': 'Arial', 'color': '#004d99'}
         },
         xaxis=dict(
@@ -116,7 +207,7 @@ def update_plot(start_date, end_date):
             range=[-0.5, 23.5]
         ),
         yaxis=dict(
-            title='Average Speed (km/h)',
+            title='Speed (km/h)' if percentiles else 'Average Speed (km/h)',
             tickfont=dict(size=12, color='#666666')
         ),
         yaxis2=dict(
@@ -136,35 +227,60 @@ def update_plot(start_date, end_date):
         template='plotly_white'
     )
     
-    # Return the figure
-    return fig
+    # Return the aggregated data and the figure
+    return grouped_df, fig
+
+# Function to export a figure as HTML bytes for download
+def export_html(fig):
+    buf = io.StringIO()
+    pio.write_html(fig, buf)
+    return buf.getvalue().encode()
 
 # Streamlit app main function
 def main():
     st.title("Traffic Dashboard General")
 
-    # File upload section
-    uploaded_file = st.file_uploader("Upload your CSV file", type="csv")
-    
-    if uploaded_file is not None and load_file(uploaded_file):
+    # Data source: a single uploaded file or the persistent aggregate store
+    source = st.radio("Data source", ["Upload CSV", "Aggregate store"], horizontal=True)
+
+    if source == "Aggregate store":
+        append_uploads('%d-%m-%Y %H:%M:%S')
+        dataset = load_from_store()
+    else:
+        # File upload section
+        uploaded_file = st.file_uploader("Upload your CSV file", type="csv")
+        backend = sql_backend.backend_selector()
+        chunked = backend == 'pandas' and st.checkbox("Chunked ingestion", help="Stream the file in blocks into hourly aggregates, for files larger than memory")
+        dataset = load_file(uploaded_file, chunked, backend) if uploaded_file is not None else None
+
+    if dataset is not None:
+        summary = dataset_summary(dataset)
+        min_date = summary['min_date']
+        max_date = summary['max_date']
+
         # Date input for filtering data
-        start_date = st.date_input(f"Start Date (available from {df['date'].min()})", df['date'].min())
-        end_date = st.date_input(f"End Date (available until {df['date'].max()})", df['date'].max())
+        start_date = st.date_input(f"Start Date (available from {min_date})", min_date)
+        end_date = st.date_input(f"End Date (available until {max_date})", max_date)
+        statistic = st.radio("Speed statistic", ["Mean", "Percentiles"], horizontal=True,
+                             help=f"Percentiles plots {', '.join(percentile_column(p) for p in PERCENTILES)} per road and hour")
         
         if st.button("Generate Plot"):
-            fig = update_plot(start_date, end_date)
+            # Repeated filters on the same data are served from the shared figure cache
+            plot = get_or_build(
+                (dataset.key, start_date, end_date, statistic),
+                lambda: update_plot(dataset, start_date, end_date, statistic),
+                export_html
+            )
             
-            if fig:
+            if plot:
                 # Display the plot
-                st.plotly_chart(fig)
+                st.plotly_chart(load_figure(plot))
                 
                 # Provide an option to download the plot as HTML
-                buf = io.StringIO()
-                pio.write_html(fig, buf)
-                html_bytes = buf.getvalue().encode()
+                html_bytes = plot.html_bytes
                 
                 # Generate the file name
-                file_name = f"Dashboard_general_{start_date}_{end_date}_plot.html"
+                file_name = f"Dashboard_general_{start_date}_{end_date}{'_percentiles' if statistic == 'Percentiles' else ''}_plot.html"
                 
                 st.download_button(
                     label="Download Plot as HTML",
@@ -173,6 +289,8 @@ def main():
                     mime='text/html'
                 )
 
+        show_cache_stats()
+
 # Run the Streamlit app
 if __name__ == "__main__":
     main()
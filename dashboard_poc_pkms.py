@@ -1,81 +1,138 @@
-import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import streamlit as st
 import io
+from ingest_cache import read_csv_cached
+from speed_cube import build_hourly_cube, summarize_cells
+from sorted_index import SortedIndex
+from dataset_registry import open_dataset
+from typed_load import optimize_dtypes
+from aggregate_store import append_uploads, open_store_dataset
+from figure_cache import get_or_build, load_figure, show_cache_stats
+import sql_backend
 
-# Global DataFrame
-df = pd.DataFrame()
+def build_dataset(file):
+    """
+    Build the shared dataset: the hourly cube, sorted and indexed on (sentido, date, pkm).
+    """
+    df = read_csv_cached(file, {'tiempo': '%d-%m-%Y %H:%M:%S'})
+
+    # Check if necessary columns exist
+    required_columns = ['carretera', 'velocidad_promedio', 'sentido', 'pkm']
+    for col in required_columns:
+        if col not in df.columns:
+            raise ValueError(f"Required column is missing: {col}")
+
+    # Compact dtypes before building the derived structures
+    df, memory_report = optimize_dtypes(df, 'speed_pkms')
+
+    # Pre-aggregate once so every plot only combines cube cells; the raw rows are not kept
+    return {'cube_index': SortedIndex(build_hourly_cube(df)), 'memory_report': memory_report}
+
+def build_store_dataset(cube, sketch):
+    """
+    Build the shared dataset from the hourly cube of the aggregate store; the
+    speed sketch is not used by this dashboard.
+    """
+    for col in ['sentido', 'pkm']:
+        if col not in cube.columns:
+            raise ValueError(f"Required column is missing: {col}")
+    return {'cube_index': SortedIndex(cube)}
+
+def build_sql_dataset(file):
+    """
+    Build the shared dataset queried through the embedded SQL engine: the path
+    of the cached Parquet file and its filter options.
+    """
+    path = sql_backend.csv_to_parquet(file, {'tiempo': '%d-%m-%Y %H:%M:%S'})
+    summary = sql_backend.speed_summary(path)
+    if 'sentidos' not in summary or 'min_pkm' not in summary:
+        raise ValueError("Required columns are missing: sentido, pkm")
+    return {'parquet_path': path, 'summary': summary}
+
+def dataset_summary(dataset):
+    """
+    Return the date range, roads, directions and PKM range of a dataset.
+    """
+    if 'parquet_path' in dataset:
+        return dataset['summary']
+    cube = dataset['cube_index'].frame
+    return {
+        'min_date': cube['date'].min().date(),
+        'max_date': cube['date'].max().date(),
+        'carreteras': cube['carretera'].unique(),
+        'sentidos': cube['sentido'].unique(),
+        'min_pkm': cube['pkm'].min(),
+        'max_pkm': cube['pkm'].max()
+    }
 
 def load_file():
     """
-    Load CSV file and preprocess data.
+    Load CSV file, or the aggregate store, and preprocess data.
     """
-    global df
-    file = st.file_uploader("Upload a CSV file", type="csv")
-    
-    if file is None:
-        st.warning("Please upload a CSV file.")
-        return False
+    source = st.radio("Data source", ["Upload CSV", "Aggregate store"], horizontal=True)
+
+    if source == "Aggregate store":
+        append_uploads('%d-%m-%Y %H:%M:%S')
+        open_data = lambda: open_store_dataset('speed_pkms', build_store_dataset)
+    else:
+        file = st.file_uploader("Upload a CSV file", type="csv")
+
+        if file is None:
+            st.warning("Please upload a CSV file.")
+            return None
+        if sql_backend.backend_selector() == 'DuckDB':
+            open_data = lambda: open_dataset(file, 'speed_pkms_sql', build_sql_dataset)
+        else:
+            open_data = lambda: open_dataset(file, 'speed_pkms', build_dataset)
 
     try:
-        df = pd.read_csv(file)
-        df['tiempo'] = pd.to_datetime(df['tiempo'], format='%d-%m-%Y %H:%M:%S')
-        df['date'] = df['tiempo'].dt.date
-        df['hour'] = df['tiempo'].dt.hour
-        
-        # Check if necessary columns exist
-        required_columns = ['carretera', 'velocidad_promedio', 'sentido', 'pkm']
-        for col in required_columns:
-            if col not in df.columns:
-                st.error(f"Required column is missing: {col}")
-                return False
+        dataset = open_data()
+        summary = dataset_summary(dataset)
+        if 'memory_report' in dataset:
+            st.caption(dataset['memory_report'])
 
         # Display available filters
-        min_date = df['date'].min()
-        max_date = df['date'].max()
-        unique_sentidos = df['sentido'].unique()
-        min_pkm = df['pkm'].min()
-        max_pkm = df['pkm'].max()
+        min_date = summary['min_date']
+        max_date = summary['max_date']
+        unique_sentidos = summary['sentidos']
+        min_pkm = summary['min_pkm']
+        max_pkm = summary['max_pkm']
 
         st.write(f"Available data from {min_date} to {max_date}")
         st.write(f"Available directions: {', '.join(unique_sentidos)}")
         st.write(f"PKM range: {min_pkm} - {max_pkm}")
         
-        return True
+        return dataset
     
     except Exception as e:
         st.error(f"Error loading file: {e}")
-        return False
+        return None
 
-def update_plot(start_date, end_date, sentido, pkm1, pkm2):
+def update_plot(dataset, start_date, end_date, sentido, pkm1, pkm2):
     """
     Generate and display the plot based on selected filters.
     """
-    if df.empty:
-        st.warning("No data available. Please load a file.")
-        return None
+    if 'parquet_path' in dataset:
+        # Date, sentido and PKM predicates and the hourly aggregation run inside the SQL engine
+        grouped_df = sql_backend.speed_by_road_hour(dataset['parquet_path'], start_date, end_date, sentido, pkm1, pkm2)
+    else:
+        cube_index = dataset['cube_index']
+        if cube_index.frame.empty:
+            st.warning("No data available. Please load a file.")
+            return None
 
-    # Filter data based on the selected date range and other filters
-    filtered_df = df[
-        (df['date'] >= start_date) &
-        (df['date'] <= end_date) & 
-        (df['sentido'] == sentido) & 
-        (df['pkm'].between(pkm1, pkm2))
-    ]
+        # Mean velocity and number of entries per 'carretera' and 'hour' for the selected filters
+        cells = cube_index.select(sentido, start_date, end_date, pkm1, pkm2)
+        grouped_df = summarize_cells(cells)
 
-    if filtered_df.empty:
+    if grouped_df.empty:
         st.warning("No data available for the selected filters.")
         return None
-
-    # Group by 'carretera' and 'hour', then calculate the mean velocity
-    grouped_df = filtered_df.groupby(['carretera', 'hour'])['velocidad_promedio'].mean().reset_index()
-
-    # Calculate the number of entries per 'carretera' and 'hour'
-    entries_count_df = filtered_df.groupby(['carretera', 'hour']).size().reset_index(name='entries')
+    entries_count_df = grouped_df
 
     # Create a consistent color map for each carretera
-    unique_carreteras = df['carretera'].unique()
+    unique_carreteras = dataset_summary(dataset)['carreteras']
     colors = {carretera: f'rgba({int(255 * i / len(unique_carreteras))}, {int(255 * (len(unique_carreteras) - i) / len(unique_carreteras))}, 150, 1)'
               for i, carretera in enumerate(unique_carreteras)}
 
@@ -159,30 +216,46 @@ def update_plot(start_date, end_date, sentido, pkm1, pkm2):
         template='plotly_white'  # Clean white background for professional appearance
     )
 
-    return fig
+    return grouped_df, fig
+
+def export_html(fig):
+    """
+    Export the plot as HTML loading plotly.js from the CDN.
+    """
+    html_buffer = io.StringIO()
+    fig.write_html(html_buffer, include_plotlyjs='cdn')
+    return html_buffer.getvalue().encode()
 
 def main():
     st.title("Traffic PKMs Data Analysis")
 
     # Load CSV and preprocess data
-    if load_file():
+    dataset = load_file()
+    if dataset is not None:
+        summary = dataset_summary(dataset)
+        min_date = summary['min_date']
+        max_date = summary['max_date']
+
         # User selects filter parameters
-        start_date = st.date_input("Start date", min_value=df['date'].min(), max_value=df['date'].max(), value=df['date'].min())
-        end_date = st.date_input("End date", min_value=df['date'].min(), max_value=df['date'].max(), value=df['date'].max())
-        sentido = st.selectbox("Direction", df['sentido'].unique())
-        pkm1, pkm2 = st.slider("Select PKM range", min_value=int(df['pkm'].min()), max_value=int(df['pkm'].max()), value=(int(df['pkm'].min()), int(df['pkm'].max())))
+        start_date = st.date_input("Start date", min_value=min_date, max_value=max_date, value=min_date)
+        end_date = st.date_input("End date", min_value=min_date, max_value=max_date, value=max_date)
+        sentido = st.selectbox("Direction", summary['sentidos'])
+        pkm1, pkm2 = st.slider("Select PKM range", min_value=int(summary['min_pkm']), max_value=int(summary['max_pkm']), value=(int(summary['min_pkm']), int(summary['max_pkm'])))
 
         # Button to generate the plot
         if st.button("Generate Plot"):
-            fig = update_plot(start_date, end_date, sentido, pkm1, pkm2)
-            if fig:
+            # Repeated filters on the same data are served from the shared figure cache
+            plot = get_or_build(
+                (dataset.key, start_date, end_date, sentido, pkm1, pkm2),
+                lambda: update_plot(dataset, start_date, end_date, sentido, pkm1, pkm2),
+                export_html
+            )
+            if plot:
                 # Display the plot in the Streamlit app
-                st.plotly_chart(fig)
+                st.plotly_chart(load_figure(plot))
 
-                # Create an HTML export of the plot
-                html_buffer = io.StringIO()
-                fig.write_html(html_buffer, include_plotlyjs='cdn')
-                html_data = html_buffer.getvalue()
+                # HTML export of the plot
+                html_data = plot.html_bytes
 
                 # Generate the filename using PKM range and sentido
                 filename = f"traffic_analysis_{pkm1}_{pkm2}_{sentido}_plot.html"
@@ -195,5 +268,7 @@ def main():
                     mime='text/html'
                 )
 
+        show_cache_stats()
+
 if __name__ == "__main__":
     main()
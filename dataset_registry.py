@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from ingest_cache import file_hash
+
+# RAM budget shared by all in-memory datasets, in megabytes
+RAM_BUDGET_MB = float(os.environ.get('DASHBOARD_RAM_BUDGET_MB', 2048))
+
+
+def object_nbytes(value):
+    """
+    Estimate the memory held by one object of a dataset.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (np.ndarray, pd.Series)):
+        return int(value.nbytes)
+    return int(getattr(value, 'nbytes', 0))
+
+
+class DatasetHandle:
+    """
+    Read-only handle on a registered dataset.
+
+    The objects are shared by every session that uploaded the same content, so
+    callers must never modify them in place.
+    """
+
+    def __init__(self, key, payload, nbytes):
+        self.key = key
+        self.nbytes = nbytes
+        self._payload = MappingProxyType(payload)
+
+    def __getitem__(self, name):
+        return self._payload[name]
+
+    def __contains__(self, name):
+        return name in self._payload
+
+
+class DatasetRegistry:
+    """
+    Process-wide store of loaded datasets, keyed by content hash.
+
+    Identical uploads from several sessions share one in-memory copy. When the
+    tracked memory exceeds the budget, the least recently used datasets are
+    dropped. Sessions only remember the key of their dataset and look it up on
+    every run, so an evicted dataset is really freed.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """
+        Return a handle on the dataset stored under `key`, building it with
+        `loader()` if needed. Concurrent requests for the same key load it once.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+
+            try:
+                payload = loader()
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+
+            handle = DatasetHandle(key, payload, sum(object_nbytes(value) for value in payload.values()))
+            # Publish the entry and retire the key lock together, so no request sees neither
+            with self._lock:
+                self._entries[key] = handle
+                self._loading.pop(key, None)
+                self._evict(keep=key)
+            return handle
+
+    def _evict(self, keep):
+        while self.total_bytes() > self.budget_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            del self._entries[oldest]
+
+    def total_bytes(self):
+        return sum(handle.nbytes for handle in self._entries.values())
+
+
+@st.cache_resource
+def get_registry():
+    """
+    Return the registry shared by all sessions of this server process.
+    """
+    return DatasetRegistry(int(RAM_BUDGET_MB * 1024 * 1024))
+
+
+def open_dataset(uploaded_file, kind, build):
+    """
+    Return a handle on the dataset that `build(uploaded_file)` produces,
+    reusing the copy already loaded for identical content.
+
+    `kind` tells apart datasets built differently from the same file. The
+    session keeps only the registry key of its upload, so the file is hashed
+    once and the handle is never pinned past eviction.
+    """
+    session_key = f"dataset_{kind}"
+    cached = st.session_state.get(session_key)
+    if cached is not None and cached[0] == uploaded_file.file_id:
+        key = cached[1]
+    else:
+        key = f"{kind}:{file_hash(uploaded_file)}"
+        st.session_state[session_key] = (uploaded_file.file_id, key)
+    return get_registry().get_or_load(key, lambda: build(uploaded_file))
@@ -1,66 +1,255 @@
+import json
+import numpy as np
 import pandas as pd
-from shapely import wkt
+import shapely
 import folium
+from branca.element import Template, MacroElement
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_folium import st_folium
 from io import BytesIO
 
-# Function to extract 2D coordinates from a geometry
-def extract_2d_coords(geometry):
-    """ Extracts 2D coordinates from a LineStringZ geometry, swapping x and y values """
-    if geometry is None:
-        return []
-    if geometry.geom_type == 'LineString':
-        return [(y, x) for x, y, _ in geometry.coords]
-    elif geometry.geom_type == 'MultiLineString':
-        return [coord for line in geometry for coord in extract_2d_coords(line)]
-    else:
-        return []
+# Function to extract 2D coordinates from an array of geometries
+def extract_2d_coords(geometries):
+    """ Extracts the 2D coordinates of every LineString(Z)/MultiLineString in bulk, swapping x and y values.
+    Returns one list of lines per geometry; other geometry types yield an empty list """
+    parts, part_owner = shapely.get_parts(geometries, return_index=True)
+    is_line = shapely.get_type_id(parts) == 1
+    parts, part_owner = parts[is_line], part_owner[is_line]
+
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    swapped = coords[:, ::-1]
+    starts = np.flatnonzero(np.diff(coord_part)) + 1
+
+    lines = [[] for _ in range(len(geometries))]
+    if len(coords):
+        for part, line in zip(coord_part[np.r_[0, starts]], np.split(swapped, starts)):
+            lines[part_owner[part]].append(line.tolist())
+    return lines
+
+# Zoom levels with precomputed simplified geometries; above the last one full resolution is used
+SIMPLIFY_ZOOMS = [6, 9, 12]
+
+# Function to get the simplification tolerance for a zoom level
+def simplify_tolerance(zoom):
+    """ Half the width in degrees of a 256px-tile pixel at the given zoom """
+    return 360 / (256 * 2 ** zoom) / 2
+
+# Function to pick the segment coordinates column for a zoom level
+def coords_column(zoom):
+    if zoom > SIMPLIFY_ZOOMS[-1]:
+        return 'coords'
+    level = max([z for z in SIMPLIFY_ZOOMS if z <= zoom], default=SIMPLIFY_ZOOMS[0])
+    return f'coords_z{level}'
 
 # Function to load the dataframe from a CSV file
-@st.cache_data
-def load_dataframe(file):
+@st.cache_resource(max_entries=4)
+def load_dataframe(_file, file_id):
+    """ Returns a segment table with one row per distinct road geometry, a compact per-date
+    table whose 'segment' column points at it, the (segments x dates) color class array and
+    the spatial index over the segments. Cached as shared read-only objects keyed by the upload
+    id, so reruns neither re-hash the file nor copy the tables or rebuild the index """
+    file = _file
     df = pd.read_csv(file)
-    df['geometry'] = df['geometry'].apply(wkt.loads)  # Convert WKT to shapely geometry
-    return df
 
-# Function to create color based on vehicle count
+    # Intern the geometries: the same road WKT repeats for every date
+    segment_ids, unique_wkt = pd.factorize(df.pop('geometry'))
+    df['segment'] = segment_ids.astype(np.int32)
+    df = df[df['segment'] >= 0].reset_index(drop=True)
+
+    geometries = shapely.from_wkt(np.asarray(unique_wkt, dtype=object))  # Convert WKT to shapely geometry in bulk
+    segments = pd.DataFrame({
+        'geometry': geometries,
+        'coords': extract_2d_coords(geometries)  # Swapped 2D lines, computed once per segment
+    })
+
+    # Simplified versions of every segment for the coarser zoom levels
+    for zoom in SIMPLIFY_ZOOMS:
+        simplified = shapely.simplify(geometries, simplify_tolerance(zoom), preserve_topology=False)
+        segments[f'coords_z{zoom}'] = extract_2d_coords(simplified)
+
+    # Compact per-date columns
+    df['fecha'] = df['fecha'].astype(pd.CategoricalDtype(sorted(df['fecha'].dropna().unique()), ordered=True))
+    df['nombre'] = df['nombre'].astype('category')
+    if 'vehicle_count' in df.columns:
+        df['vehicle_count'] = pd.to_numeric(df['vehicle_count'], downcast='integer')
+
+    # Color class of every segment on every date, -1 where the segment has no data
+    classes = np.full((len(segments), len(df['fecha'].cat.categories)), -1, dtype=np.int8)
+    counts = df['vehicle_count'].to_numpy() if 'vehicle_count' in df.columns else np.zeros(len(df))
+    date_codes = df['fecha'].cat.codes.to_numpy()
+    dated = date_codes >= 0
+    classes[df['segment'].to_numpy()[dated], date_codes[dated]] = get_color_class(counts[dated])
+
+    return segments, df, classes, build_segment_tree(segments)
+
+# Colors used for the density classes, from lowest to highest
+COLORS = ['green', 'orange', 'red']
+
+# Function to get the index in COLORS of the class of each vehicle count
+def get_color_class(vehicle_count):
+    vehicle_count = np.asarray(vehicle_count)
+    return np.select(
+        [vehicle_count < 500, (vehicle_count >= 1000) & (vehicle_count < 2500)],
+        [0, 1],
+        default=2
+    ).astype(np.int8)
+
+# Function to create colors based on vehicle counts, for a whole array at once
 def get_color(vehicle_count):
-    if vehicle_count < 500:
-        return 'green'
-    elif 1000 <= vehicle_count < 2500:
-        return 'orange'
-    else:
-        return 'red'
+    return np.array(COLORS)[get_color_class(vehicle_count)]
+
+# Fraction of the viewport size added on each side when culling segments
+VIEWPORT_MARGIN = 0.25
+
+# Function to convert st_folium bounds into a (west, south, east, north) box
+def viewport_box(bounds, margin=VIEWPORT_MARGIN):
+    """ Returns the bounds reported by st_folium expanded by `margin` times their size, or None if unknown """
+    try:
+        south, west = bounds['_southWest']['lat'], bounds['_southWest']['lng']
+        north, east = bounds['_northEast']['lat'], bounds['_northEast']['lng']
+    except (KeyError, TypeError):
+        return None
+    if None in (south, west, north, east):
+        return None
+    dx, dy = (east - west) * margin, (north - south) * margin
+    return (west - dx, south - dy, east + dx, north + dy)
+
+# Function to check whether a box lies inside another one
+def box_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+# Function to build the spatial index over the segment bounding boxes
+def build_segment_tree(segments):
+    return shapely.STRtree(segments['geometry'].to_numpy())
 
 # Function to generate the map
-def generate_map(df, selected_date, road_type):
+def generate_map(segments, df, selected_date, road_type, zoom=6, location=None, viewport=None, tree=None):
     filtered_df = df[(df['fecha'] == str(selected_date)) & (df['nombre'] == road_type)]
 
     if filtered_df.empty:
         return None, "No data found for the selected date and road type."
 
-    m = folium.Map(location=[40.4168, -3.7038], zoom_start=6, tiles='CartoDB Positron')
+    # Keep only the segments intersecting the viewport
+    if viewport is not None:
+        visible = tree.query(shapely.box(*viewport))
+        filtered_df = filtered_df[np.isin(filtered_df['segment'].to_numpy(), visible)]
 
-    for _, road in filtered_df.iterrows():
-        vehicle_count = road.get('vehicle_count', 0)
-        color = get_color(vehicle_count)
-        coords = extract_2d_coords(road.geometry)
-        if road.geometry.geom_type == 'MultiLineString':
-            coords = [coord for sublist in coords for coord in sublist]
-        folium.PolyLine(coords, color=color, weight=5).add_to(m)
+    m = folium.Map(location=location or [40.4168, -3.7038], zoom_start=zoom, tiles='CartoDB Positron')
+
+    if 'vehicle_count' in filtered_df.columns:
+        colors = get_color(filtered_df['vehicle_count'].to_numpy())
+    else:
+        colors = get_color(np.zeros(len(filtered_df)))
+
+    # One multi-line layer per color instead of one PolyLine per road
+    segment_coords = segments[coords_column(zoom)].to_numpy()
+    segment_ids = filtered_df['segment'].to_numpy()
+    for color in COLORS:
+        lines = [line for segment in segment_ids[colors == color] for line in segment_coords[segment]]
+        if lines:
+            folium.PolyLine(lines, color=color, weight=5).add_to(m)
 
     html_data = BytesIO()
     m.save(html_data, close_file=False)
     
     return m, html_data
 
+# Function to add the date playback control and the road layers it restyles
+def add_playback(m, lines, classes, dates, interval_ms=1000):
+    """ Sends every segment geometry once; moving between dates only swaps the polyline styles """
+    template = '''
+    {% macro script(this, kwargs) %}
+    (function() {
+        var map = {{ this._parent.get_name() }};
+        var lines = {{ this.lines }};
+        var classes = {{ this.classes }};
+        var dates = {{ this.dates }};
+        var colors = {{ this.colors }};
+        var layers = lines.map(function(segment) { return L.polyline(segment, {weight: 5}).addTo(map); });
+        var slider, label, button, timer = null;
+
+        function show(d) {
+            var day = classes[d];
+            layers.forEach(function(layer, i) {
+                layer.setStyle(day[i] < 0 ? {opacity: 0} : {color: colors[day[i]], opacity: 1});
+            });
+            label.innerHTML = ' ' + dates[d];
+        }
+
+        var control = L.control({position: 'bottomleft'});
+        control.onAdd = function() {
+            var div = L.DomUtil.create('div', 'leaflet-bar');
+            div.style.background = 'white';
+            div.style.padding = '6px';
+            button = L.DomUtil.create('button', '', div);
+            button.innerHTML = '&#9654;';
+            slider = L.DomUtil.create('input', '', div);
+            slider.type = 'range';
+            slider.min = 0;
+            slider.max = dates.length - 1;
+            slider.value = 0;
+            label = L.DomUtil.create('span', '', div);
+            L.DomEvent.disableClickPropagation(div);
+
+            slider.addEventListener('input', function() { show(+slider.value); });
+            button.addEventListener('click', function() {
+                if (timer) {
+                    clearInterval(timer);
+                    timer = null;
+                    button.innerHTML = '&#9654;';
+                    return;
+                }
+                button.innerHTML = '&#10074;&#10074;';
+                timer = setInterval(function() {
+                    slider.value = (+slider.value + 1) % dates.length;
+                    show(+slider.value);
+                }, {{ this.interval_ms }});
+            });
+            return div;
+        };
+        control.addTo(map);
+        show(0);
+    })();
+    {% endmacro %}
+    '''
+    playback = MacroElement()
+    playback._template = Template(template)
+    playback.lines = json.dumps(lines)
+    playback.classes = json.dumps(classes.T.tolist())
+    playback.dates = json.dumps([str(date) for date in dates])
+    playback.colors = json.dumps(COLORS)
+    playback.interval_ms = interval_ms
+    m.add_child(playback)
+
+# Function to generate the date playback map
+def generate_playback_map(segments, df, classes, road_type, zoom=6):
+    segment_ids = np.unique(df.loc[df['nombre'] == road_type, 'segment'].to_numpy())
+
+    if not len(segment_ids):
+        return None, "No data found for the selected road type."
+
+    m = folium.Map(location=[40.4168, -3.7038], zoom_start=zoom, tiles='CartoDB Positron')
+    lines = segments[coords_column(zoom)].to_numpy()[segment_ids].tolist()
+    add_playback(m, lines, classes[segment_ids], df['fecha'].cat.categories)
+
+    html_data = BytesIO()
+    m.save(html_data, close_file=False)
+
+    return m, html_data
+
 # Streamlit app
 st.title("Density Traffic Map Generator")
 
 # Initialize session state variables
 if 'df' not in st.session_state:
     st.session_state.df = None
+if 'segments' not in st.session_state:
+    st.session_state.segments = None
+if 'classes' not in st.session_state:
+    st.session_state.classes = None
+if 'playback' not in st.session_state:
+    st.session_state.playback = False
 if 'map_generated' not in st.session_state:
     st.session_state.map_generated = False
 if 'html_data' not in st.session_state:
@@ -71,13 +260,19 @@ if 'selected_date' not in st.session_state:
     st.session_state.selected_date = None
 if 'road_type' not in st.session_state:
     st.session_state.road_type = None
+if 'segment_tree' not in st.session_state:
+    st.session_state.segment_tree = None
+if 'rendered_viewport' not in st.session_state:
+    st.session_state.rendered_viewport = None
+if 'rendered_coords' not in st.session_state:
+    st.session_state.rendered_coords = None
 
 # Step 1: Upload CSV file
 uploaded_file = st.file_uploader("Upload CSV file", type="csv")
 
 if uploaded_file is not None:
-    st.session_state.df = load_dataframe(uploaded_file)
-    st.success(f"CSV file loaded with {len(st.session_state.df)} entries.")
+    st.session_state.segments, st.session_state.df, st.session_state.classes, st.session_state.segment_tree = load_dataframe(uploaded_file, uploaded_file.file_id)
+    st.success(f"CSV file loaded with {len(st.session_state.df)} entries over {len(st.session_state.segments)} road segments.")
 
 # Ensure the selection widgets are only displayed after a file is loaded
 if st.session_state.df is not None:
@@ -90,30 +285,78 @@ if st.session_state.df is not None:
 
     selected_date = st.date_input("Select date", min_value=min_date, max_value=max_date, key='date_input')
     road_type = st.selectbox("Select road type", road_types, key='road_select')
-
-    # Save selections to session state
-    st.session_state.selected_date = selected_date
-    st.session_state.road_type = road_type
+    zoom = st.slider("Map detail (zoom level)", min_value=6, max_value=18, value=6,
+                     help="Geometries are simplified to fit this zoom; raise it for detailed local views or exports")
+    viewport_only = st.checkbox("Only render the visible area",
+                                help="Re-render only the segments inside the current map view when panning or zooming")
+    playback = st.checkbox("Date playback",
+                           help="Send the roads once with a time slider that moves through every date without re-rendering")
 
     # Enable button only if both date and road type are selected
     generate_button_enabled = selected_date and road_type
     if st.button("Generate Map", disabled=not generate_button_enabled):
-        st.session_state.map_object, st.session_state.html_data = generate_map(
-            st.session_state.df,
-            st.session_state.selected_date,
-            st.session_state.road_type
-        )
+        # Save the selections of the rendered map, so culling re-renders keep them even if the widgets change
+        st.session_state.selected_date = selected_date
+        st.session_state.road_type = road_type
+
+        if playback:
+            st.session_state.map_object, st.session_state.html_data = generate_playback_map(
+                st.session_state.segments,
+                st.session_state.df,
+                st.session_state.classes,
+                st.session_state.road_type,
+                zoom
+            )
+        else:
+            st.session_state.map_object, st.session_state.html_data = generate_map(
+                st.session_state.segments,
+                st.session_state.df,
+                st.session_state.selected_date,
+                st.session_state.road_type,
+                zoom
+            )
+        st.session_state.playback = playback
         st.session_state.map_generated = st.session_state.html_data is not None
+        st.session_state.rendered_viewport = None
+        st.session_state.rendered_coords = coords_column(zoom)
 
 # Check if the map was generated before and persist it
 if st.session_state.map_generated and st.session_state.map_object is not None:
-    # Display the map stored in session state
-    st_folium(st.session_state.map_object, width=700, height=500)
+    # Display the map stored in session state; the playback map runs its own script, so it is embedded as HTML
+    if st.session_state.playback:
+        components.html(st.session_state.html_data.getvalue().decode(), height=500)
+        map_state = None
+    else:
+        map_state = st_folium(st.session_state.map_object, width=700, height=500, key='density_map')
+
+    # Re-render only the visible segments when the view leaves the rendered area or needs finer geometry
+    view = viewport_box(map_state.get('bounds'), margin=0) if viewport_only and map_state else None
+    if view is not None:
+        view_zoom = map_state.get('zoom') or 6
+        rendered = st.session_state.rendered_viewport
+        if rendered is None or not box_contains(rendered, view) or st.session_state.rendered_coords != coords_column(view_zoom):
+            center = map_state.get('center') or {}
+            viewport = viewport_box(map_state['bounds'])
+            st.session_state.map_object, st.session_state.html_data = generate_map(
+                st.session_state.segments,
+                st.session_state.df,
+                st.session_state.selected_date,
+                st.session_state.road_type,
+                view_zoom,
+                location=[center['lat'], center['lng']] if center else None,
+                viewport=viewport,
+                tree=st.session_state.segment_tree
+            )
+            st.session_state.map_generated = st.session_state.html_data is not None
+            st.session_state.rendered_viewport = viewport
+            st.session_state.rendered_coords = coords_column(view_zoom)
+            st.rerun()
 
     # Allow the user to download the map after it is generated
     st.download_button(
         label="Download Density Heatmap as HTML",
         data=st.session_state.html_data.getvalue(),
-        file_name=f"traffic_map_{st.session_state.selected_date}_{st.session_state.road_type}.html",
+        file_name=(f"traffic_map_playback_{st.session_state.road_type}.html" if st.session_state.playback
+                   else f"traffic_map_{st.session_state.selected_date}_{st.session_state.road_type}.html"),
         mime='text/html'
     )
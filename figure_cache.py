@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import plotly.io as pio
+import streamlit as st
+
+# Memory budget for cached figures, in megabytes
+FIGURE_CACHE_MB = float(os.environ.get('DASHBOARD_FIGURE_CACHE_MB', 256))
+
+# Aggregated frame, Plotly figure JSON and exported HTML bytes of one plot
+CachedFigure = namedtuple('CachedFigure', ['aggregated', 'figure_json', 'html_bytes'])
+
+
+def entry_nbytes(entry):
+    """
+    Estimate the memory held by a cached figure.
+    """
+    return int(entry.aggregated.memory_usage(deep=True).sum()) + len(entry.figure_json) + len(entry.html_bytes)
+
+
+class FigureCache:
+    """
+    Size-bounded LRU cache of finished plots, keyed by (dataset hash, filters),
+    with hit and miss counters.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, figure):
+        nbytes = entry_nbytes(figure)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (figure, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'nbytes': self._nbytes}
+
+
+@st.cache_resource
+def get_figure_cache():
+    """
+    Return the figure cache shared by all sessions of this server process.
+    """
+    return FigureCache(int(FIGURE_CACHE_MB * 1024 * 1024))
+
+
+def get_or_build(key, build, export_html):
+    """
+    Return the cached plot for `key`, or build it and cache it.
+
+    `build()` returns an (aggregated frame, figure) pair, or None when there is
+    nothing to plot; `export_html(fig)` returns the bytes offered for download.
+    """
+    cache = get_figure_cache()
+    figure = cache.get(key)
+    if figure is None:
+        built = build()
+        if built is None:
+            return None
+        aggregated, fig = built
+        figure = CachedFigure(aggregated, fig.to_json(), export_html(fig))
+        cache.put(key, figure)
+    return figure
+
+
+def load_figure(figure):
+    """
+    Rebuild the Plotly figure of a cached plot.
+    """
+    return pio.from_json(figure.figure_json)
+
+
+def show_cache_stats():
+    """
+    Display the figure cache counters in the sidebar.
+    """
+    stats = get_figure_cache().stats()
+    st.sidebar.caption(f"Figure cache: {stats['hits']} hits, {stats['misses']} misses, "
+                       f"{stats['entries']} plots ({stats['nbytes'] / 1024 / 1024:.1f} MB)")
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+
+import pandas as pd
+
+# Directory holding the columnar copies of uploaded files
+CACHE_DIR = os.environ.get('DASHBOARD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dashboard_poc_cache'))
+
+# Size of the blocks read while hashing an upload
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def file_hash(uploaded_file):
+    """
+    Return the SHA-256 hex digest of an uploaded file, leaving it rewound.
+    """
+    digest = hashlib.sha256()
+    uploaded_file.seek(0)
+    for block in iter(lambda: uploaded_file.read(HASH_CHUNK_SIZE), b''):
+        digest.update(block)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def cache_path(key, extension='parquet'):
+    """
+    Return the path of the cache entry stored under `key`.
+    """
+    return os.path.join(CACHE_DIR, f"{key}.{extension}")
+
+
+def cache_key(content_hash, datetime_columns=None):
+    """
+    Combine the file content hash with the parsing options, so the same upload
+    parsed two different ways does not share a cache entry.
+    """
+    options = json.dumps(datetime_columns or {}, sort_keys=True)
+    return hashlib.sha256(f"{content_hash}:{options}".encode()).hexdigest()
+
+
+def temp_path(path):
+    """
+    Return a unique temporary name next to `path`, so concurrent writers in the
+    same process never share a temporary file.
+    """
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def write_parquet_atomic(df, path):
+    """
+    Write `df` to `path` through a temporary file, so a concurrent reader never
+    sees a partially written cache entry.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = temp_path(path)
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def read_csv_cached(uploaded_file, datetime_columns=None):
+    """
+    Read an uploaded CSV, converting it once to a typed Parquet file.
+
+    `datetime_columns` maps column names to the `pd.to_datetime` format used to
+    parse them. Later uploads of the same content reload the parsed Parquet copy
+    instead of parsing the CSV again.
+    """
+    key = cache_key(file_hash(uploaded_file), datetime_columns)
+    path = cache_path(key)
+
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+
+    df = pd.read_csv(uploaded_file)
+    for column, fmt in (datetime_columns or {}).items():
+        df[column] = pd.to_datetime(df[column], format=fmt)
+
+    write_parquet_atomic(df, path)
+    return df
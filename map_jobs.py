@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+# Worker threads shared by all sessions for map generation
+MAP_WORKERS = int(os.environ.get('DASHBOARD_MAP_WORKERS', 2))
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when every session attached to it has cancelled.
+    """
+
+
+def job_id(*parts):
+    """
+    Return the id of the job computing `parts`, typically the dataset content
+    hash followed by the generation parameters.
+    """
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+class Job:
+    """
+    A background computation shared by the sessions attached to it.
+
+    The worker reports progress through `report(fraction, text)` and must call
+    `check_cancelled()` regularly; neither touches Streamlit.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.refcount = 1
+        self.fraction = 0.0
+        self.text = ''
+
+    def report(self, fraction, text=''):
+        self.fraction, self.text = min(max(fraction, 0.0), 1.0), text
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+
+class JobManager:
+    """
+    Run jobs on a worker pool, attaching identical in-flight requests to the
+    same job and cancelling it once no session is attached any more.
+
+    Only running jobs are tracked: a job is dropped as soon as it finishes, and
+    attached sessions read the result from the handle they hold, so abandoned
+    sessions never keep results alive in the manager.
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='map-job')
+        self._jobs = {}
+        # Reentrant: the done callback runs inline when the job finishes before it is registered
+        self._lock = threading.RLock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Return the job `key`, starting `fn(*args, job=job, **kwargs)` if no live
+        job with that key exists.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.cancel_event.is_set():
+                job.refcount += 1
+                return job
+
+            job = Job(key)
+            job.future = self._executor.submit(fn, *args, job=job, **kwargs)
+            self._jobs[key] = job
+            job.future.add_done_callback(lambda _: self._forget(job))
+            return job
+
+    def _forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def release(self, job):
+        """
+        Detach a session from a job, cancelling it when it was the last one.
+        """
+        with self._lock:
+            job.refcount -= 1
+            if job.refcount > 0:
+                return
+        self._forget(job)
+        if not job.done():
+            job.cancel_event.set()
+            job.future.cancel()
+
+
+@st.cache_resource
+def get_job_manager():
+    """
+    Return the job manager shared by all sessions of this server process.
+    """
+    return JobManager(MAP_WORKERS)
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+# Columns the frame is sorted on
+INDEX_KEYS = ['sentido', 'date', 'pkm']
+
+
+def to_day(value):
+    """
+    Convert a date-like value to a numpy day.
+    """
+    return pd.Timestamp(value).to_datetime64().astype('datetime64[D]')
+
+
+class SortedIndex:
+    """
+    A frame sorted once on (sentido, date, pkm), with the start and stop offsets
+    of every (sentido, date) block.
+
+    Filtering by sentido, date range and PKM range becomes a few binary
+    searches plus one slice per selected day, instead of full-length boolean
+    masks over every row.
+    """
+
+    def __init__(self, df):
+        frame = df.dropna(subset=INDEX_KEYS)
+        self.frame = frame.sort_values(INDEX_KEYS, kind='mergesort').reset_index(drop=True)
+
+        # Codes follow the sort order, so they are non-decreasing along the frame
+        sentido_codes, self.sentidos = pd.factorize(self.frame['sentido'])
+        days = self.frame['date'].to_numpy(dtype='datetime64[D]')
+        self.pkm = self.frame['pkm'].to_numpy()
+
+        if len(self.frame):
+            changes = (np.diff(sentido_codes) != 0) | (np.diff(days) != np.timedelta64(0, 'D'))
+            boundaries = np.flatnonzero(changes) + 1
+            self.block_starts = np.r_[0, boundaries]
+            self.block_stops = np.r_[boundaries, len(self.frame)]
+        else:
+            self.block_starts = np.empty(0, dtype=np.intp)
+            self.block_stops = np.empty(0, dtype=np.intp)
+
+        self.block_sentido = sentido_codes[self.block_starts]
+        self.block_day = days[self.block_starts]
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the sorted frame and the block offsets.
+        """
+        arrays = (self.pkm, self.block_starts, self.block_stops, self.block_sentido, self.block_day)
+        return int(self.frame.memory_usage(deep=True).sum()) + sum(array.nbytes for array in arrays)
+
+    def blocks(self, sentido, start_date, end_date):
+        """
+        Return the range of block numbers for `sentido` between both dates.
+        """
+        matches = np.flatnonzero(np.asarray(self.sentidos == sentido))
+        if not len(matches):
+            return 0, 0
+
+        low = np.searchsorted(self.block_sentido, matches[0], side='left')
+        high = np.searchsorted(self.block_sentido, matches[0], side='right')
+        days = self.block_day[low:high]
+        first = low + np.searchsorted(days, to_day(start_date), side='left')
+        last = low + np.searchsorted(days, to_day(end_date), side='right')
+        return first, last
+
+    def positions(self, sentido, start_date, end_date, pkm_min, pkm_max):
+        """
+        Return the row positions in `frame` matching all the filters.
+        """
+        first, last = self.blocks(sentido, start_date, end_date)
+
+        parts = []
+        for start, stop in zip(self.block_starts[first:last], self.block_stops[first:last]):
+            pkm = self.pkm[start:stop]
+            parts.append(np.arange(start + np.searchsorted(pkm, pkm_min, side='left'),
+                                   start + np.searchsorted(pkm, pkm_max, side='right')))
+
+        if not parts:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(parts)
+
+    def select(self, sentido, start_date, end_date, pkm_min, pkm_max):
+        """
+        Return the rows of `frame` matching all the filters.
+        """
+        return self.frame.iloc[self.positions(sentido, start_date, end_date, pkm_min, pkm_max)]
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Dimensions of the hourly cube, in grouping order
+CUBE_KEYS = ['date', 'carretera', 'sentido', 'pkm', 'hour']
+
+# Aggregated measures of every cube cell
+CUBE_MEASURES = ['speed_sum', 'speed_count', 'entries']
+
+# Rows read per block in chunked ingestion
+CHUNK_ROWS = 1_000_000
+
+# Partial cubes kept before they are folded together
+PARTIALS_PER_FOLD = 8
+
+
+def build_hourly_cube(df):
+    """
+    Pre-aggregate the raw speed rows into one cell per
+    (date, carretera, sentido, pkm, hour).
+
+    Each cell keeps the sum and the non-null count of `velocidad_promedio`,
+    plus the number of raw rows, so means and entry counts for any combination
+    of cells can be recovered exactly. `sentido` and `pkm` are only used when
+    present in the file. Rows with missing keys keep their own cells, so they
+    still count in views that do not filter on those keys. Expects the `date`
+    and `hour` keys of `optimize_dtypes`.
+    """
+    groupers = [df[key] for key in CUBE_KEYS if key in df.columns]
+
+    cube = df['velocidad_promedio'].groupby(groupers, observed=True, dropna=False).agg(
+        speed_sum='sum',
+        speed_count='count',
+        entries='size'
+    )
+    # Float32 speeds are summed in float64 once combined across many cells
+    return cube.astype({'speed_sum': 'float64'}).reset_index()
+
+
+def combine_cubes(cubes):
+    """
+    Merge partial cubes, summing the measures of cells with the same keys.
+    """
+    cube = pd.concat(cubes, ignore_index=True)
+    keys = [key for key in CUBE_KEYS if key in cube.columns]
+    return cube.groupby(keys, observed=True, dropna=False)[CUBE_MEASURES].sum().reset_index()
+
+
+def build_hourly_cube_chunked(file, datetime_format, chunk_rows=CHUNK_ROWS, progress=None, on_chunk=None):
+    """
+    Build the hourly cube by streaming the CSV in blocks of `chunk_rows` rows.
+
+    Each block is parsed and folded into partial aggregates, so the raw rows
+    are never resident at once. `progress`, if given, is called with the
+    fraction of the file read after every block; `on_chunk`, if given, is
+    called with every parsed block so other summaries can be built in the
+    same pass.
+    """
+    file.seek(0, os.SEEK_END)
+    total_bytes = max(file.tell(), 1)
+    file.seek(0)
+
+    partials = []
+    for chunk in pd.read_csv(file, chunksize=chunk_rows):
+        if 'carretera' not in chunk.columns or 'velocidad_promedio' not in chunk.columns:
+            raise ValueError("Required columns are missing in the file")
+
+        tiempo = pd.to_datetime(chunk['tiempo'], format=datetime_format)
+        chunk['date'] = tiempo.dt.normalize()
+        chunk['hour'] = tiempo.dt.hour.astype(np.int8)
+        chunk['velocidad_promedio'] = chunk['velocidad_promedio'].astype(np.float32)
+        partials.append(build_hourly_cube(chunk))
+        if on_chunk is not None:
+            on_chunk(chunk)
+
+        if len(partials) >= PARTIALS_PER_FOLD:
+            partials = [combine_cubes(partials)]
+        if progress is not None:
+            progress(min(file.tell() / total_bytes, 1.0))
+
+    if not partials:
+        raise ValueError("The file has no rows")
+
+    cube = combine_cubes(partials)
+    for key in ('carretera', 'sentido'):
+        if key in cube.columns:
+            cube[key] = cube[key].astype('category')
+    return cube
+
+
+def query_cube(cube, start_date, end_date, sentido=None, pkm1=None, pkm2=None):
+    """
+    Combine the cube cells matching the filters into the per (carretera, hour)
+    mean speed and number of entries.
+    """
+    mask = (cube['date'] >= pd.Timestamp(start_date)) & (cube['date'] <= pd.Timestamp(end_date))
+    if sentido is not None:
+        mask &= cube['sentido'] == sentido
+    if pkm1 is not None and pkm2 is not None:
+        mask &= cube['pkm'].between(pkm1, pkm2)
+
+    return summarize_cells(cube[mask])
+
+
+def summarize_cells(cells):
+    """
+    Fold cube cells into the per (carretera, hour) mean speed and entries.
+    """
+    totals = cells.groupby(['carretera', 'hour'], observed=True)[['speed_sum', 'speed_count', 'entries']].sum()
+    totals['velocidad_promedio'] = totals['speed_sum'] / totals['speed_count']
+    return totals[['velocidad_promedio', 'entries']].reset_index()
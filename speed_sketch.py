@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+from speed_cube import PARTIALS_PER_FOLD
+
+# Dimensions of the speed sketches, in grouping order
+SKETCH_KEYS = ['date', 'carretera', 'sentido', 'hour']
+
+# Compression of the sketches: about this many centroids per cell at most
+DELTA = 100
+
+# Percentiles offered by the dashboards
+PERCENTILES = [0.15, 0.5, 0.85]
+
+
+def compress(centroids, keys, delta=DELTA):
+    """
+    Merge weighted centroids into at most about `delta` centroids per group of
+    `keys`, in the manner of a merging t-digest.
+
+    Centroids are ranked by mean inside each group and bucketed on the arcsine
+    scale of their quantile, so the tails keep small centroids and the middle
+    is merged more aggressively. Every group is handled in one vectorized pass.
+    """
+    centroids = centroids.sort_values(keys + ['mean'], kind='stable', ignore_index=True)
+    groupers = [centroids[key] for key in keys]
+    weight = centroids['weight'].astype(np.float64)
+    grouped = weight.groupby(groupers, observed=True, sort=False, dropna=False)
+    quantile = (grouped.cumsum() - weight / 2) / grouped.transform('sum')
+    bucket = pd.Series(np.floor(delta * (np.arcsin(2 * quantile - 1) / np.pi + 0.5)).astype(np.int16), name='bucket')
+
+    merged = pd.DataFrame({'weighted': centroids['mean'].astype(np.float64) * weight, 'weight': weight})
+    merged = merged.groupby(groupers + [bucket], observed=True, sort=False, dropna=False).sum()
+    merged.index = merged.index.droplevel(-1)
+    merged.index.names = keys
+
+    sketch = pd.DataFrame({
+        'mean': (merged['weighted'] / merged['weight']).astype(np.float32),
+        'weight': merged['weight'].astype(np.int64)
+    }).reset_index()
+    return sketch.sort_values(keys + ['mean'], kind='stable', ignore_index=True)
+
+
+def build_speed_sketch(df, delta=DELTA):
+    """
+    Summarize the `velocidad_promedio` values of every
+    (date, carretera, sentido, hour) cell as a quantile sketch.
+
+    `sentido` is only used when present in the file. Expects the `date` and
+    `hour` keys of `optimize_dtypes`.
+    """
+    keys = [key for key in SKETCH_KEYS if key in df.columns]
+    speeds = df[keys + ['velocidad_promedio']].dropna(subset=['velocidad_promedio'])
+    centroids = speeds.rename(columns={'velocidad_promedio': 'mean'}).assign(weight=1)
+    return compress(centroids, keys, delta)
+
+
+def combine_sketches(sketches, delta=DELTA):
+    """
+    Merge partial sketches of the same cells.
+    """
+    sketch = pd.concat(sketches, ignore_index=True)
+    return compress(sketch, [key for key in SKETCH_KEYS if key in sketch.columns], delta)
+
+
+class StreamingSketch:
+    """
+    Fold the chunks of a chunked ingestion into one sketch, merging partials as
+    they accumulate like the hourly cube does.
+    """
+
+    def __init__(self, delta=DELTA):
+        self.delta = delta
+        self.partials = []
+
+    def add(self, chunk):
+        self.partials.append(build_speed_sketch(chunk, self.delta))
+        if len(self.partials) >= PARTIALS_PER_FOLD:
+            self.partials = [combine_sketches(self.partials, self.delta)]
+
+    def result(self):
+        sketch = combine_sketches(self.partials, self.delta)
+        for key in ('carretera', 'sentido'):
+            if key in sketch.columns:
+                sketch[key] = sketch[key].astype('category')
+        return sketch
+
+
+def query_percentiles(sketch, start_date, end_date, percentiles=PERCENTILES):
+    """
+    Merge the sketches of the selected dates into per (carretera, hour)
+    percentiles of `velocidad_promedio`, one column per percentile (`p15`, ...).
+    """
+    mask = (sketch['date'] >= pd.Timestamp(start_date)) & (sketch['date'] <= pd.Timestamp(end_date))
+    merged = compress(sketch[mask], ['carretera', 'hour'])
+
+    rows = []
+    for (carretera, hour), group in merged.groupby(['carretera', 'hour'], observed=True, sort=False):
+        weight = group['weight'].to_numpy(np.float64)
+        # Each centroid stands at the quantile of its centre of mass
+        centres = (np.cumsum(weight) - weight / 2) / weight.sum()
+        values = np.interp(percentiles, centres, group['mean'].to_numpy())
+        rows.append({'carretera': carretera, 'hour': hour,
+                     **{percentile_column(p): value for p, value in zip(percentiles, values)}})
+
+    return pd.DataFrame(rows, columns=['carretera', 'hour'] + [percentile_column(p) for p in percentiles])
+
+
+def percentile_column(p):
+    return f"p{round(p * 100)}"
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import streamlit as st
+
+from ingest_cache import CACHE_DIR, cache_key, cache_path, file_hash, temp_path
+from speed_sketch import percentile_column
+
+# DuckDB is optional: the dashboards fall back to pandas when it is missing
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Query engines offered by the dashboards
+BACKENDS = ['pandas', 'DuckDB']
+
+
+def available():
+    """
+    Return True when the embedded SQL engine can be used.
+    """
+    return duckdb is not None
+
+
+def backend_selector():
+    """
+    Show the query backend selector and return the backend to use, falling
+    back to pandas when DuckDB is not installed.
+    """
+    backend = st.radio("Query backend", BACKENDS, horizontal=True,
+                       help="DuckDB queries the cached Parquet file directly instead of keeping aggregates in memory")
+    if backend == 'DuckDB' and not available():
+        st.warning("DuckDB is not installed; using pandas.")
+        return 'pandas'
+    return backend
+
+
+def sql_literal(value):
+    """
+    Quote a string as a SQL literal.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def query(sql, params=()):
+    """
+    Run a query on a fresh in-process connection and return a DataFrame.
+    """
+    with duckdb.connect() as con:
+        return con.execute(sql, list(params)).df()
+
+
+def csv_to_parquet(uploaded_file, datetime_columns):
+    """
+    Return the path of the Parquet copy of an uploaded CSV, converting it with
+    DuckDB if it is not cached yet.
+
+    The conversion streams from a temporary copy on disk, deleted afterwards,
+    so the file is never loaded into pandas. The cache entry is the one
+    `read_csv_cached` uses for the same options, so both backends share it.
+    """
+    path = cache_path(cache_key(file_hash(uploaded_file), datetime_columns))
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, csv_path = tempfile.mkstemp(suffix='.csv', dir=CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            shutil.copyfileobj(uploaded_file, target)
+        uploaded_file.seek(0)
+
+        types = ', '.join(f"{sql_literal(column)}: 'VARCHAR'" for column in datetime_columns)
+        replaced = ', '.join(f'strptime("{column}", {sql_literal(fmt)}) AS "{column}"' for column, fmt in datetime_columns.items())
+        tmp_path = temp_path(path)
+        with duckdb.connect() as con:
+            con.execute(
+                f"COPY (SELECT * REPLACE ({replaced}) FROM read_csv({sql_literal(csv_path)}, header = true, types = {{{types}}})) "
+                f"TO {sql_literal(tmp_path)} (FORMAT PARQUET)"
+            )
+        os.replace(tmp_path, path)
+    finally:
+        os.remove(csv_path)
+    return path
+
+
+def day_range(start_date, end_date):
+    """
+    Return the [start, end) timestamps covering the days from `start_date` to
+    `end_date`, so date filters stay plain range predicates on the raw column
+    and Parquet row groups can be pruned on their min/max statistics.
+    """
+    return [pd.Timestamp(start_date).to_pydatetime(), (pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_pydatetime()]
+
+
+def speed_summary(path):
+    """
+    Return the filter options available in a speed file.
+    """
+    source = f"read_parquet({sql_literal(path)})"
+    columns = set(query(f"DESCRIBE SELECT * FROM {source}")['column_name'])
+    bounds = query(f"SELECT min(CAST(tiempo AS DATE)) AS min_date, max(CAST(tiempo AS DATE)) AS max_date FROM {source}")
+    summary = {
+        'min_date': pd.Timestamp(bounds['min_date'][0]).date(),
+        'max_date': pd.Timestamp(bounds['max_date'][0]).date(),
+        'carreteras': query(f"SELECT DISTINCT carretera FROM {source} WHERE carretera IS NOT NULL ORDER BY 1")['carretera'].to_numpy()
+    }
+    if 'sentido' in columns:
+        summary['sentidos'] = query(f"SELECT DISTINCT sentido FROM {source} WHERE sentido IS NOT NULL ORDER BY 1")['sentido'].to_numpy()
+    if 'pkm' in columns:
+        pkm = query(f"SELECT min(pkm) AS min_pkm, max(pkm) AS max_pkm FROM {source}")
+        summary['min_pkm'], summary['max_pkm'] = pkm['min_pkm'][0], pkm['max_pkm'][0]
+    return summary
+
+
+def speed_by_road_hour(path, start_date, end_date, sentido=None, pkm1=None, pkm2=None, percentiles=None):
+    """
+    Return the mean speed and number of entries per (carretera, hour), with the
+    date, sentido and PKM predicates and the aggregation pushed down to SQL.
+
+    `percentiles`, if given, adds one column of exact speed percentiles per
+    value (`p15`, ...).
+    """
+    conditions = ["carretera IS NOT NULL", "tiempo >= ? AND tiempo < ?"]
+    params = day_range(start_date, end_date)
+    if sentido is not None:
+        conditions.append("sentido = ?")
+        params.append(sentido)
+    if pkm1 is not None and pkm2 is not None:
+        conditions.append("pkm BETWEEN ? AND ?")
+        params += [pkm1, pkm2]
+    quantiles = ''.join(f", quantile_cont(velocidad_promedio, {float(p)}) AS {percentile_column(p)}" for p in percentiles or [])
+
+    return query(
+        f"SELECT carretera, hour(tiempo) AS hour, avg(velocidad_promedio) AS velocidad_promedio, count(*) AS entries{quantiles} "
+        f"FROM read_parquet({sql_literal(path)}) WHERE {' AND '.join(conditions)} "
+        f"GROUP BY carretera, hour ORDER BY carretera, hour",
+        params
+    )
+
+
+def travel_time_summary(path):
+    """
+    Return the filter options available in a travel-time file.
+    """
+    source = f"read_parquet({sql_literal(path)})"
+    bounds = query(f"SELECT min(CAST(date AS DATE)) AS min_date, max(CAST(date AS DATE)) AS max_date, "
+                   f"min(pkm) AS min_pkm, max(pkm) AS max_pkm FROM {source}")
+    return {
+        'min_date': pd.Timestamp(bounds['min_date'][0]).date(),
+        'max_date': pd.Timestamp(bounds['max_date'][0]).date(),
+        'sentidos': query(f"SELECT DISTINCT sentido FROM {source} WHERE sentido IS NOT NULL ORDER BY 1")['sentido'].to_numpy(),
+        'min_pkm': bounds['min_pkm'][0],
+        'max_pkm': bounds['max_pkm'][0]
+    }
+
+
+def travel_time_by_hour(path, selected_date, pkm_min, pkm_max, sentido):
+    """
+    Return the sum of `avg_time_diff` per hour for one date, PKM range and
+    sentido, computed by the SQL engine.
+    """
+    return query(
+        f"SELECT hour, coalesce(sum(avg_time_diff), 0) AS avg_time_diff FROM read_parquet({sql_literal(path)}) "
+        f"WHERE date >= ? AND date < ? AND pkm BETWEEN ? AND ? AND sentido = ? "
+        f"GROUP BY hour ORDER BY hour",
+        day_range(selected_date, selected_date) + [pkm_min, pkm_max, sentido]
+    )
@@ -0,0 +1,59 @@
+import numpy as np
+
+from sorted_index import to_day
+
+# Number of hourly columns kept per PKM
+HOURS = 24
+
+
+class TravelTimePrefixSums:
+    """
+    Cumulative sums of `avg_time_diff` over PKM for each of the 24 hours,
+    one table per (sentido, date).
+
+    The hourly sums for any PKM range are the difference of two rows of the
+    table, so a query costs two binary searches and O(24) arithmetic whatever
+    the number of rows in the file.
+    """
+
+    def __init__(self, df):
+        totals = df.groupby(['sentido', 'date', 'pkm', 'hour'], observed=True)['avg_time_diff'].agg(['sum', 'size'])
+        sums = totals['sum'].unstack('hour', fill_value=0).reindex(columns=range(HOURS), fill_value=0)
+        counts = totals['size'].unstack('hour', fill_value=0).reindex(columns=range(HOURS), fill_value=0)
+
+        sum_values = sums.to_numpy(dtype=np.float64)
+        count_values = counts.to_numpy(dtype=np.int64)
+        pkm_values = sums.index.get_level_values('pkm').to_numpy()
+        zeros = np.zeros((1, HOURS))
+
+        # Map (sentido, day) to the sorted PKMs and the prefix tables with a leading zero row
+        self.blocks = {}
+        for (sentido, date), positions in sums.groupby(level=['sentido', 'date'], sort=False).indices.items():
+            self.blocks[(sentido, to_day(date))] = (
+                pkm_values[positions],
+                np.vstack([zeros, np.cumsum(sum_values[positions], axis=0)]),
+                np.vstack([zeros, np.cumsum(count_values[positions], axis=0)])
+            )
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the prefix tables.
+        """
+        return sum(array.nbytes for block in self.blocks.values() for array in block)
+
+    def hourly_sums(self, sentido, date, pkm_min, pkm_max):
+        """
+        Return the per-hour sum of `avg_time_diff` and the per-hour number of rows
+        for PKMs between `pkm_min` and `pkm_max`, or None if the day has no data.
+        """
+        block = self.blocks.get((sentido, to_day(date)))
+        if block is None:
+            return None
+
+        pkm, cum_sums, cum_counts = block
+        first = np.searchsorted(pkm, pkm_min, side='left')
+        last = np.searchsorted(pkm, pkm_max, side='right')
+        if last <= first:
+            return None
+        return cum_sums[last] - cum_sums[first], cum_counts[last] - cum_counts[first]
@@ -0,0 +1,71 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Low-cardinality text columns stored as categoricals
+CATEGORY_COLUMNS = ['carretera', 'sentido']
+
+# Measurement columns stored as float32
+FLOAT_COLUMNS = ['velocidad_promedio', 'avg_time_diff']
+
+
+def frame_nbytes(df):
+    """
+    Return the memory used by a DataFrame, including object contents.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def compact_numeric(series):
+    """
+    Downcast a numeric column to the smallest integer type when it only holds
+    whole numbers.
+
+    Fractional values are kept as float64: they are compared against float64
+    filter bounds, and float32 rounding would move rows across the boundaries.
+    """
+    values = series.to_numpy()
+    if series.notna().all() and np.array_equal(values, np.round(values)):
+        return pd.to_numeric(series, downcast='integer')
+    return series.astype(np.float64)
+
+
+def optimize_dtypes(df, name='dataset'):
+    """
+    Convert a freshly loaded frame to compact dtypes in place and return it
+    with a one-line memory report of its size before and after, which the
+    dashboards display next to the load status.
+
+    Roads and directions become categoricals, `date` becomes a datetime64 day
+    key, hours and whole PKMs become small integers and metrics become float32. The
+    `date` and `hour` columns are derived from `tiempo` when it is present.
+    """
+    before = frame_nbytes(df)
+
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    if 'tiempo' in df.columns:
+        df['date'] = df['tiempo'].dt.normalize()
+        df['hour'] = df['tiempo'].dt.hour.astype(np.int8)
+    else:
+        if 'date' in df.columns:
+            df['date'] = df['date'].dt.normalize()
+        if 'hour' in df.columns:
+            df['hour'] = compact_numeric(df['hour'])
+
+    if 'pkm' in df.columns:
+        df['pkm'] = compact_numeric(df['pkm'])
+
+    for column in FLOAT_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype(np.float32)
+
+    after = frame_nbytes(df)
+    report = f"{name}: {len(df):,} rows, {before / 1024 / 1024:.1f} MB before typing, {after / 1024 / 1024:.1f} MB after"
+    logger.info("%s (%s)", report, ', '.join(f"{column}={dtype}" for column, dtype in df.dtypes.items()))
+    return df, report